@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Reproducible benchmarks of the conversion and scoring paths, on synthetic
+# data generated at a configurable scale, so that they run offline (the
+# transcriptions are not in the repository).
+#
+# The generated collation has the witnesses of the reduced matrix, PET and,
+# to reach the requested number of witnesses, additional synthetic ones;
+# `missing` is the rate at which a witness is absent from a locus (which
+# makes `build_matrix()` fall back to missing data) or has an omission.
+# Each case is run in a fresh worker process, so that its peak memory is
+# measured by itself, and results (wall and CPU time, throughput, and peak
+# memory) are appended as a JSON line to the results file.
+#
+# As previous data is removed or overwritten, the work directories are
+# marked with a BENCHMARK_MARKER file, and directories which are not empty
+# and have no marker (such as `data`) are refused.
+
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import nexus2csv
+import nexusio
+import parsimony
+import shaw2nexus
+import test_asr
+import transcription2nexus as t2n
+
+# predefined scales: number of verses, witnesses, states per locus (at
+# most), and missing data rate
+SCALES = {
+    'small' : {'verses' : 100, 'witnesses' : 12, 'states' : 4,
+        'missing' : 0.05},
+    'medium' : {'verses' : 1000, 'witnesses' : 24, 'states' : 6,
+        'missing' : 0.05},
+    'large' : {'verses' : 5000, 'witnesses' : 40, 'states' : 8,
+        'missing' : 0.05},
+}
+
+# witnesses always in the collation, as needed by `test_asr`
+BASE_WITNESSES = ['PET', 'Rb', 'Urb', 'Ash', 'Ham', 'Triv', 'Mart',
+    'Mart-c2', 'LauSC']
+
+# stemma of the reduced witnesses, for the synthetic ASR dump
+SYNTHETIC_TREE = '((Rb,Urb),((Ash,Ham),((Triv,Mart,Mart_c2),LauSC)));'
+
+WORDS = ['nel', 'mezzo', 'del', 'cammin', 'di', 'nostra', 'vita', 'mi',
+    'ritrovai', 'per', 'una', 'selva', 'oscura', 'che', 'la', 'diritta',
+    'via', 'era', 'smarrita', 'ahi', 'quanto', 'a', 'dir', 'qual']
+
+VERSES_PER_CANTO = 30
+
+# file marking the directories generated by the benchmark
+BENCHMARK_MARKER = '.benchmark'
+
+def benchmark_dir(path):
+    # create or reuse a work directory, raising a ValueError if it is not
+    # empty and it was not created by the benchmark, so that real data
+    # (e.g., with `workdir='data'`) is never removed or overwritten
+    os.makedirs(path, exist_ok=True)
+    marker = os.path.join(path, BENCHMARK_MARKER)
+    if os.listdir(path) and not os.path.exists(marker):
+        raise ValueError('%s is not a benchmark directory (no %s file), '
+            'refusing to overwrite it' % (path, BENCHMARK_MARKER))
+    open(marker, 'a').close()
+
+def witness_names(num):
+    # BASE_WITNESSES, extended with synthetic ones up to `num`
+    return BASE_WITNESSES + ['W%02d' % idx
+        for idx in range(max(num - len(BASE_WITNESSES), 0))]
+
+def generate_collation(path, verses=100, witnesses=12, states=4,
+    missing=0.05, seed=0):
+    # write `verses` verse files in the format of the transcriptions,
+    # distributed over the three cantiche
+    rng = random.Random(seed)
+    names = witness_names(witnesses)
+    benchmark_dir(path)
+
+    # remove the verses of previous runs, which might be at a larger scale
+    for filename in t2n.verse_filenames(None, path):
+        os.remove(filename)
+
+    for v_idx in range(verses):
+        cantica = ['IN', 'PU', 'PA'][v_idx % 3]
+        canto = v_idx // 3 // VERSES_PER_CANTO + 1
+        verso = v_idx // 3 % VERSES_PER_CANTO + 1
+
+        loci = []
+        for _ in range(rng.randint(4, 9)):
+            forms = rng.sample(WORDS, rng.randint(1, states))
+            locus = dict((form, []) for form in forms)
+            for name in names:
+                draw = rng.random()
+                if draw < missing:
+                    continue
+                elif draw < 2 * missing:
+                    locus.setdefault('*om.**', []).append(name)
+                elif rng.random() < 0.8:
+                    locus[forms[0]].append(name)
+                else:
+                    locus[rng.choice(forms)].append(name)
+
+            locus = dict((form, w_names) for form, w_names in locus.items()
+                if w_names)
+
+            # LEOnardi's readings must be among the states of the locus
+            label = '%s_%02d_%03d_%i' % (t2n.CANTICA[cantica], canto, verso,
+                len(loci))
+            if label in t2n.LEONARDI:
+                locus.setdefault(t2n.LEONARDI[label], [])
+
+            loci.append(locus)
+
+        filename = '%s_%02d_%03d.json' % (cantica, canto, verso)
+        with open(os.path.join(path, filename), 'w') as handler:
+            json.dump(loci, handler)
+
+def generate_shaw(filename, loci=3000, witnesses=8, missing=0.05, seed=0):
+    # write a file in the format of Shaw's NEXUS files, with loci as rows
+    rng = random.Random(seed)
+    taxa = ['Ash', 'Ham', 'LauSC', 'Mart', 'Rb', 'Triv', 'Urb', 'Ald'] + [
+        'W%02d' % idx for idx in range(max(witnesses - 8, 0))]
+    taxa = taxa[:witnesses]
+
+    with open(filename, 'w') as handler:
+        handler.write('#NEXUS\nBEGIN CHARACTERS;\n\tCHARSTATELABELS\n')
+        labels = ['W_%s%02d_%03d_%d' % (rng.choice(['IN', 'PU', 'PA']),
+            rng.randint(1, 33), rng.randint(1, 140), idx)
+            for idx in range(loci)]
+        for idx, label in enumerate(labels):
+            handler.write('\t%i %s %s\n' % (idx+1, label,
+                ' '.join(rng.sample(WORDS, 2))))
+        handler.write('\t;\n\tTAXLABELS\n')
+        for idx, taxon in enumerate(taxa):
+            handler.write('\t%i %s\n' % (idx+1, taxon))
+        handler.write('\t;\n\tMATRIX\n')
+        for idx, label in enumerate(labels):
+            base = rng.choice('0123')
+            handler.write('\t%i %s %s\n' % (idx+1, label, ''.join([
+                base if rng.random() > missing else rng.choice('01?-')
+                for _ in taxa])))
+        handler.write('\t;\nendblock;\n')
+
+def prepare(workdir, scale, seed=0):
+    # generate all the input files of the benchmarks in `workdir`
+    params = SCALES[scale] if isinstance(scale, str) else scale
+    benchmark_dir(workdir)
+    generate_collation(os.path.join(workdir, 'transcription'), seed=seed,
+        **params)
+
+    # reduced matrix and its ASR dump, as done with Mesquite
+    data = t2n.read_data(None, os.path.join(workdir, 'transcription'), False,
+        _descripti(params), processes=1)
+    reduced = os.path.join(workdir, 'reduced.nex')
+    with _muted():
+        t2n.output_data(data, reduced, [], '\nBEGIN Trees;\n' +
+            "tree 'Tresoldi'=[&R] %s\nEND;\n" % SYNTHETIC_TREE)
+    tree = dict(nexusio.read_trees(reduced))['Tresoldi']
+    parsimony.output_asr(tree, nexusio.read_matrix(reduced),
+        os.path.join(workdir, 'asr.txt'))
+
+    generate_shaw(os.path.join(workdir, 'shaw.nex'),
+        loci=params['verses'] * 6, missing=params['missing'], seed=seed)
+
+def _descripti(params):
+    # all witnesses but the WITNESSES of `test_asr`
+    return [name for name in witness_names(params['witnesses'])
+        if name.replace('-', ' ') not in test_asr.WITNESSES]
+
+# benchmark cases: each takes the work directory and the parameters, does
+# any setup, and returns the function to time and the number of items it
+# processes (for throughput)
+
+def case_read_data(workdir, params):
+    path = os.path.join(workdir, 'transcription')
+    items = len(t2n.verse_filenames(None, path))
+    return lambda: t2n.read_data(None, path, processes=1), items
+
+def case_output_data(workdir, params):
+    data = t2n.read_data(None, os.path.join(workdir, 'transcription'),
+        processes=1)
+    out_file = os.path.join(workdir, 'output.nex')
+    return lambda: t2n.output_data(data, out_file), len(data['chars'])
+
+def case_shaw(workdir, params):
+    filename = os.path.join(workdir, 'shaw.nex')
+    def run():
+        # the parsed files are cached by `read_shaw_nexus()`
+        shaw2nexus._read_shaw_nexus.cache_clear()
+        shaw = shaw2nexus.read_shaw_nexus(filename)
+        shaw2nexus.extract_matrix(shaw['matrix'],
+            sorted(list(shaw['states'].keys())))
+    return run, params['verses'] * 6
+
+def case_nexus2csv(workdir, params):
+    in_file = os.path.join(workdir, 'reduced.nex')
+    out_file = os.path.join(workdir, 'chars.csv')
+    items = len(list(nexusio.iter_charstatelabels(in_file)))
+    return lambda: nexus2csv.main(in_file, out_file), items
+
+def case_read_asr(workdir, params):
+    filename = os.path.join(workdir, 'asr.txt')
+    items = len(list(nexusio.iter_charstatelabels(
+        os.path.join(workdir, 'reduced.nex'))))
+    return lambda: test_asr.read_asr_data(filename, cache=False), items
+
+def case_similarity(workdir, params):
+    asr, info_states = test_asr.read_asr_data(
+        os.path.join(workdir, 'asr.txt'), cache=False)
+    nexus = t2n.read_data(None, os.path.join(workdir, 'transcription'), False,
+        _descripti(params), processes=1)
+    return lambda: test_asr.test_similarity(asr, nexus, info_states), len(asr)
+
+CASES = [
+    ('read_data', case_read_data),
+    ('output_data', case_output_data),
+    ('shaw', case_shaw),
+    ('nexus2csv', case_nexus2csv),
+    ('read_asr_data', case_read_asr),
+    ('test_similarity', case_similarity),
+]
+
+@contextlib.contextmanager
+def _muted():
+    # silence the output and the warnings of the benchmarked code
+    logging.disable(logging.WARNING)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+def _run_case(name, workdir, params, repeat):
+    # time a case in the current (worker) process, with the best of
+    # `repeat` runs
+    with _muted():
+        func, items = dict(CASES)[name](workdir, params)
+
+    timings = []
+    for _ in range(repeat):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        with _muted():
+            func()
+        timings.append((time.perf_counter() - wall,
+            time.process_time() - cpu))
+    wall, cpu = min(timings)
+
+    return {
+        'case' : name,
+        'items' : items,
+        'wall' : wall,
+        'cpu' : cpu,
+        'throughput' : items / wall if wall else None,
+        'peak_memory_kb' : (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if resource else None),
+    }
+
+def run(workdir='benchmark', scale='small', cases=None, repeat=3,
+    results_file='benchmark_results.jsonl', seed=0):
+    # generate the data for `scale` (a name in SCALES or a dictionary with
+    # the same keys) and run all `cases` (by default, all of them), each in
+    # a fresh process, appending the results to `results_file`
+    params = SCALES[scale] if isinstance(scale, str) else scale
+    prepare(workdir, params, seed)
+
+    results = []
+    for name, _ in CASES:
+        if cases and name not in cases:
+            continue
+        with multiprocessing.Pool(1) as pool:
+            result = pool.apply(_run_case, (name, workdir, params, repeat))
+        results.append(result)
+        print('%-16s %10.4fs %12.1f items/s %10s KB' % (name,
+            result['wall'], result['throughput'] or 0,
+            result['peak_memory_kb']))
+
+    with open(results_file, 'a') as handler:
+        handler.write(json.dumps({
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python' : platform.python_version(),
+            'scale' : scale if isinstance(scale, str) else None,
+            'params' : params,
+            'seed' : seed,
+            'results' : results,
+        }, sort_keys=True) + '\n')
+
+    return results
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Change-point detection of shifts in the affiliation of witnesses, such as
+# those caused by a change of exemplar partway through a cantica.
+#
+# For each pair of witnesses, the signal is the sequence of agreements (1)
+# and disagreements (0) over the loci where both have a reading. The signal
+# is split by binary segmentation, using the sum of squared errors of the
+# mean of each segment as cost: with cumulative sums computed once, the
+# cost of any segment is computed in constant time, so that each level of
+# the segmentation scans the whole poem in linear time. Splits are kept if
+# they lower the cost by more than a BIC-like penalty.
+
+import math
+
+import charmatrix
+import nexusio
+
+# minimum number of compared loci in a segment
+MIN_SIZE = 200
+
+# multiplier of the default penalty, `PENALTY * variance * log(n)`
+PENALTY = 3.0
+
+def agreement_signal(matrix, taxon_a, taxon_b):
+    # (character indices, agreements) for the loci where both witnesses
+    # have a reading, with agreements as a bytearray of 0 and 1
+    unknown = (charmatrix.GAP, charmatrix.MISSING)
+    positions = []
+    values = bytearray()
+    for c_idx, (code_a, code_b) in enumerate(zip(matrix['rows'][taxon_a],
+        matrix['rows'][taxon_b])):
+        if code_a not in unknown and code_b not in unknown:
+            positions.append(c_idx)
+            values.append(code_a == code_b)
+
+    return positions, values
+
+def _cost(sums, start, end):
+    # sum of squared errors of `values[start:end]` around its mean; as
+    # values are 0 and 1, the sum of squares is the sum itself
+    total = sums[end] - sums[start]
+    return total - total * total / (end - start)
+
+def binary_segmentation(values, penalty=None, min_size=MIN_SIZE):
+    # sorted list of the indices where the mean of `values` changes
+    n = len(values)
+    if n < 2 * min_size:
+        return []
+
+    sums = [0]
+    for value in values:
+        sums.append(sums[-1] + value)
+    if penalty is None:
+        mean = sums[n] / n
+        penalty = PENALTY * max(mean * (1 - mean), 1 / n) * math.log(n)
+
+    breaks = []
+    segments = [(0, n)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2 * min_size:
+            continue
+
+        cost = _cost(sums, start, end)
+        best = None
+        for split in range(start + min_size, end - min_size + 1):
+            gain = cost - _cost(sums, start, split) - _cost(sums, split, end)
+            if best is None or gain > best[0]:
+                best = (gain, split)
+
+        if best[0] > penalty:
+            breaks.append(best[1])
+            segments += [(start, best[1]), (best[1], end)]
+
+    return sorted(breaks)
+
+def canto_of(matrix, c_idx):
+    # (cantica, canto) of a character, from labels as in 'I_01_001_0'
+    cantica, canto = matrix['chars'][c_idx].split('_')[:2]
+    return cantica, int(canto)
+
+def segments(matrix, positions, values, breaks):
+    # list of (first canto, last canto, agreement rate) for the segments
+    # between `breaks` (indices into `positions` and `values`)
+    ret = []
+    bounds = [0] + breaks + [len(values)]
+    for start, end in zip(bounds, bounds[1:]):
+        ret.append((canto_of(matrix, positions[start]),
+            canto_of(matrix, positions[end-1]),
+            sum(values[start:end]) / (end - start)))
+
+    return ret
+
+def affiliation_shifts(matrix, penalty=None, min_size=MIN_SIZE):
+    # segments of every pair of witnesses with at least one change point,
+    # as a dictionary
+    taxa = matrix['taxa']
+    ret = {}
+    for i, taxon_a in enumerate(taxa):
+        for taxon_b in taxa[i+1:]:
+            positions, values = agreement_signal(matrix, taxon_a, taxon_b)
+            breaks = binary_segmentation(values, penalty, min_size)
+            if breaks:
+                ret[taxon_a, taxon_b] = segments(matrix, positions, values,
+                    breaks)
+
+    return ret
+
+def partition_bounds(shifts):
+    # sorted list of the cantos where any pair of witnesses starts a new
+    # segment, to be used as the boundaries of partitions of the matrix
+    bounds = set()
+    for pair_segments in shifts.values():
+        for first, _, _ in pair_segments[1:]:
+            bounds.add(first)
+
+    return sorted(bounds)
+
+def main():
+    matrix = nexusio.read_matrix('data/tresoldi_red.nex')
+    shifts = affiliation_shifts(matrix)
+    for (taxon_a, taxon_b), pair_segments in sorted(shifts.items()):
+        for first, last, rate in pair_segments:
+            print(taxon_a, taxon_b, '%s %i' % first, '%s %i' % last,
+                '%.4f' % rate)
+
+    print('bounds', ' '.join(['%s %i' % canto
+        for canto in partition_bounds(shifts)]))
+
+if __name__ == '__main__':
+    main()
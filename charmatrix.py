@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Compact character matrices, shared by the conversion and analysis scripts.
+#
+# A matrix is a dictionary with the (sorted) list of `taxa`, the list of
+# `chars` labels, a list of `state_labels` for each character (in the same
+# order as `chars`), and the `rows`, a dictionary mapping each taxon to a
+# bytearray with one state code per character. Codes are the index of the
+# state in the list of labels for the character, with two special values
+# for gaps and missing data, so that a full Commedia matrix takes about
+# 3 MB instead of millions of Python objects.
+
+GAP = 0xFE
+MISSING = 0xFF
+
+# translation tables between codes and NEXUS symbols, used to serialize and
+# parse whole rows in bulk; symbols are single digits, as in the SYMBOLS
+# declared by our NEXUS files
+_CODE2SYMBOL = bytearray(b'?' * 256)
+_SYMBOL2CODE = bytearray([MISSING] * 256)
+for _code in range(10):
+    _CODE2SYMBOL[_code] = ord(str(_code))
+    _SYMBOL2CODE[ord(str(_code))] = _code
+_CODE2SYMBOL[GAP] = ord('-')
+_SYMBOL2CODE[ord('-')] = GAP
+CODE2SYMBOL = bytes(_CODE2SYMBOL)
+SYMBOL2CODE = bytes(_SYMBOL2CODE)
+_SPECIAL_CODES = bytes([GAP, MISSING])
+
+def new_matrix(taxa, chars, state_labels):
+    # build a matrix with all cells set to missing data
+    return {
+        'taxa' : list(taxa),
+        'chars' : list(chars),
+        'state_labels' : list(state_labels),
+        'rows' : dict((taxon, bytearray([MISSING]) * len(chars))
+            for taxon in taxa),
+    }
+
+def max_states(matrix):
+    # maximum number of states (excluding gaps and missing data) of any
+    # character in the matrix
+    return max([len(labels) for labels in matrix['state_labels']] or [0])
+
+def max_code(row):
+    # largest state code in a row, excluding gaps and missing data (-1 if
+    # there are none)
+    codes = row.translate(None, _SPECIAL_CODES)
+    return max(codes) if codes else -1
+
+def n_codes(matrix):
+    # number of state codes used by the matrix: the number of state labels
+    # of its characters or, when larger, the largest code in the rows plus
+    # one, as matrices read from files without (complete) CHARSTATELABELS
+    # have codes without labels
+    return max([max_states(matrix)] + [max_code(row) + 1
+        for row in matrix['rows'].values()])
+
+def row_symbols(matrix, taxon):
+    # serialize the row of `taxon` as a string of NEXUS symbols; codes
+    # above 9 cannot be represented by single digits, in which case the
+    # (slower) decimal representation is used for each cell
+    row = matrix['rows'][taxon]
+    if max_code(row) < 10:
+        return row.translate(CODE2SYMBOL).decode('ascii')
+
+    return ''.join([CODE2SYMBOL[code:code+1].decode('ascii')
+        if code in (GAP, MISSING) else str(code) for code in row])
+
+def code_mask(row, code):
+    # integer whose bit `i` is set if `row[i] == code`, used by the
+    # bit-parallel algorithms on whole rows
+    table = bytearray(b'0' * 256)
+    table[code] = ord('1')
+    return int(row.translate(table)[::-1] or b'0', 2)
+
+def iter_rows(matrix):
+    # yield (taxon, symbols) for all rows, as read from NEXUS matrices
+    for taxon in matrix['taxa']:
+        yield taxon, row_symbols(matrix, taxon)
+
+def encode_symbols(symbols):
+    # parse a string of NEXUS symbols (e.g., a MATRIX row) into a bytearray
+    # of codes; unknown symbols are read as missing data
+    return bytearray(symbols.encode('ascii', 'replace').translate(SYMBOL2CODE))
+
+def subset(matrix, taxa=None, char_indices=None):
+    # extract a new matrix with only the given `taxa` and characters
+    # (indices into `matrix['chars']`), keeping their order
+    if taxa is None:
+        taxa = matrix['taxa']
+    if char_indices is None:
+        char_indices = range(len(matrix['chars']))
+
+    char_indices = list(char_indices)
+    ret = {
+        'taxa' : list(taxa),
+        'chars' : [matrix['chars'][i] for i in char_indices],
+        'state_labels' : [matrix['state_labels'][i] for i in char_indices],
+        'rows' : {},
+    }
+
+    for taxon in ret['taxa']:
+        row = matrix['rows'][taxon]
+        ret['rows'][taxon] = bytearray([row[i] for i in char_indices])
+
+    return ret
+
+def compress_columns(rows, ignore=(), drop_invariant=False):
+    # collapse identical columns of `rows` (a list of sequences of the same
+    # length, such as bytearrays of codes or strings of symbols) into
+    # unique site patterns, returning the `columns` of each pattern (as
+    # tuples, in order of first occurrence), their integer `weights`, the
+    # `index` of original columns for each pattern, and the number of
+    # `invariant` sites, i.e., those with less than two states once
+    # symbols in `ignore` (gaps and missing data) are disregarded; invariant
+    # sites are still counted when they are dropped
+    ignore = set(ignore)
+    pattern_idx = {}
+    ret = {
+        'columns' : [],
+        'weights' : [],
+        'index' : [],
+        'invariant' : 0,
+    }
+
+    for c_idx, column in enumerate(zip(*rows)):
+        if column not in pattern_idx:
+            # first occurrence of the pattern; invariant ones are mapped
+            # to a negative index when dropping them
+            is_invariant = len(set(column) - ignore) < 2
+            if is_invariant and drop_invariant:
+                p_idx = -1
+            else:
+                p_idx = len(ret['columns'])
+                ret['columns'].append(column)
+                ret['weights'].append(0)
+                ret['index'].append([])
+
+            pattern_idx[column] = (p_idx, is_invariant)
+
+        p_idx, is_invariant = pattern_idx[column]
+        if is_invariant:
+            ret['invariant'] += 1
+        if p_idx >= 0:
+            ret['weights'][p_idx] += 1
+            ret['index'][p_idx].append(c_idx)
+
+    return ret
+
+def compress_patterns(matrix, drop_invariant=False):
+    # build a new matrix with one character per unique site pattern, using
+    # the label and state labels of its first original character; the
+    # matrix gets the additional `weights`, `index` (pattern -> original
+    # character indices), `loci` (pattern -> original character labels),
+    # `sites` (number of original characters), and `invariant` (number of
+    # invariant sites) keys
+    taxa = matrix['taxa']
+    patterns = compress_columns([matrix['rows'][taxon] for taxon in taxa],
+        (GAP, MISSING), drop_invariant)
+
+    first = [index[0] for index in patterns['index']]
+    ret = {
+        'taxa' : list(taxa),
+        'chars' : [matrix['chars'][i] for i in first],
+        'state_labels' : [matrix['state_labels'][i] for i in first],
+        'rows' : dict((taxon, bytearray()) for taxon in taxa),
+        'weights' : patterns['weights'],
+        'index' : patterns['index'],
+        'loci' : [[matrix['chars'][i] for i in index]
+            for index in patterns['index']],
+        'sites' : len(matrix['chars']),
+        'invariant' : patterns['invariant'],
+    }
+
+    for taxon, row in zip(taxa, zip(*patterns['columns'])):
+        ret['rows'][taxon] = bytearray(row)
+
+    return ret
+
+def loci_comments(loci):
+    # bracketed comments with the original loci of each (1-based) pattern,
+    # e.g. "[2: I_01_001_3 I_01_004_0]", so that the characters of a
+    # compressed file can be mapped back to the loci they stand for
+    return ['[%i: %s]' % (p_idx+1, ' '.join(labels))
+        for p_idx, labels in enumerate(loci)]
+
+def weights_sets(weights):
+    # group (1-based) character numbers by weight, as used by NEXUS
+    # WTSET commands, e.g. {1: [1, 3], 5: [2]}
+    ret = {}
+    for c_idx, weight in enumerate(weights):
+        ret.setdefault(weight, []).append(c_idx+1)
+
+    return ret
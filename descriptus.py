@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Detection of codices descripti in the full matrix (including the '-orig',
+# '-c1', '-c2' layers of the manuscripts): a witness is flagged as a copy
+# of another if it agrees with it in all the readings it has, except for
+# its own singular readings (those found in no other witness), i.e., if its
+# readings are a superset-with-errors of those of its exemplar.
+#
+# All counts are computed with the per-state bit masks of `distances`: the
+# sites where each state is found in at least two witnesses are collected
+# once, and then, for each pair of witnesses, the compared, agreeing and
+# non-singular disagreeing sites are a few mask operations and popcounts.
+
+import distances
+import nexusio
+import transcription2nexus as t2n
+
+def shared_masks(masks):
+    # for each state, the mask of the sites where it is found in at least
+    # two witnesses
+    n_states = len(next(iter(masks.values()))[1]) if masks else 0
+    once = [0] * n_states
+    twice = [0] * n_states
+    for known, states in masks.values():
+        for idx, state in enumerate(states):
+            twice[idx] |= once[idx] & state
+            once[idx] |= state
+
+    return twice
+
+def singular_masks(masks):
+    # witness -> mask of the sites with a singular reading of the witness
+    twice = shared_masks(masks)
+    ret = {}
+    for taxon, (known, states) in masks.items():
+        singular = 0
+        for state, shared in zip(states, twice):
+            singular |= state & ~shared
+        ret[taxon] = singular & known
+
+    return ret
+
+def pair_stats(matrix):
+    # statistics of every ordered pair (copy, exemplar) of witnesses: the
+    # number of `compared` sites (where both have a reading), `agreements`,
+    # `singular` readings of the copy, and `residual` disagreements, those
+    # which are not singular readings of the copy
+    masks = distances.taxon_masks(matrix)
+    singular = singular_masks(masks)
+
+    ret = {}
+    for copy in matrix['taxa']:
+        for exemplar in matrix['taxa']:
+            if copy == exemplar:
+                continue
+            (known_a, states_a), (known_b, states_b) = \
+                masks[copy], masks[exemplar]
+            compared = known_a & known_b
+            equal = 0
+            for state_a, state_b in zip(states_a, states_b):
+                equal |= state_a & state_b
+            disagreements = compared & ~equal
+
+            ret[copy, exemplar] = {
+                'compared' : compared.bit_count(),
+                'agreements' : (compared & equal).bit_count(),
+                'singular' : (singular[copy] & compared).bit_count(),
+                'residual' : (disagreements & ~singular[copy]).bit_count(),
+            }
+
+    return ret
+
+def detect_descripti(matrix, max_residual=0, min_compared=1):
+    # list of (copy, exemplar, stats) for the pairs in which the copy
+    # disagrees with the exemplar in at most `max_residual` sites besides
+    # its singular readings, sorted by copy and number of residual sites
+    ret = [(copy, exemplar, stats)
+        for (copy, exemplar), stats in pair_stats(matrix).items()
+        if stats['residual'] <= max_residual and
+            stats['compared'] >= min_compared]
+
+    return sorted(ret, key=lambda item: (item[0], item[2]['residual'],
+        item[1]))
+
+def check_descripti(matrix, expected=None, **options):
+    # compare the descripti found in `matrix` with the `expected` ones (by
+    # default, those removed by `tonexus()`), returning the lists of the
+    # expected ones not found, and of the found ones not expected; labels
+    # are compared as in NEXUS files, with underscores
+    if expected is None:
+        expected = t2n.DESCRIPTI
+    expected = set([w.replace('-', '_') for w in expected])
+    found = set([copy.replace('-', '_')
+        for copy, _, _ in detect_descripti(matrix, **options)])
+
+    return sorted(expected - found), sorted(found - expected)
+
+def main():
+    matrix = nexusio.read_matrix('data/tresoldi.nex')
+    for copy, exemplar, stats in detect_descripti(matrix):
+        print(copy, exemplar, stats['compared'], stats['agreements'],
+            stats['singular'], stats['residual'])
+
+    not_found, not_expected = check_descripti(matrix)
+    print('expected, not found:', ' '.join(not_found))
+    print('found, not expected:', ' '.join(not_expected))
+
+if __name__ == '__main__':
+    main()
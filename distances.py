@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Pairwise distances between witnesses, replacing the round-trip through
+# external tools (such as SplitsTree for the NeighborNet figures).
+#
+# Each row of the character matrix is turned into one integer bit mask for
+# each state, plus a mask of the sites where the state is known, so that
+# the number of compared and differing sites of a pair of witnesses is
+# given by a few big-integer operations and popcounts. Missing data and
+# gaps are either ignored (the site is not compared for the pair) or
+# treated as a state of their own.
+
+import logging
+import multiprocessing
+import random
+
+import charmatrix
+import nexusio
+
+# ways to handle missing data and gaps
+IGNORE = 'ignore'
+STATE = 'state'
+
+def taxon_masks(matrix, missing=IGNORE, gaps=IGNORE):
+    # (known, state masks) for each taxon, where `known` has the sites
+    # taking part in comparisons and the state masks have the sites in
+    # each state (including missing data and gaps when treated as states)
+    codes = list(range(charmatrix.n_codes(matrix)))
+    ignored = []
+    for code, handling in [(charmatrix.MISSING, missing),
+        (charmatrix.GAP, gaps)]:
+        if handling == STATE:
+            codes.append(code)
+        elif handling == IGNORE:
+            ignored.append(code)
+        else:
+            raise ValueError('unknown handling %r' % (handling,))
+
+    all_sites = (1 << len(matrix['chars'])) - 1
+    ret = {}
+    for taxon in matrix['taxa']:
+        row = matrix['rows'][taxon]
+        known = all_sites
+        for code in ignored:
+            known &= ~charmatrix.code_mask(row, code)
+        ret[taxon] = (known, [charmatrix.code_mask(row, code)
+            for code in codes])
+
+    return ret
+
+def pair_counts(masks_a, masks_b):
+    # number of (compared, differing) sites of a pair of witnesses
+    compared = masks_a[0] & masks_b[0]
+    equal = 0
+    for state_a, state_b in zip(masks_a[1], masks_b[1]):
+        equal |= state_a & state_b
+
+    return compared.bit_count(), (compared & ~equal).bit_count()
+
+def distance_matrix(matrix, missing=IGNORE, gaps=IGNORE, hamming=False):
+    # square matrix (a list of lists, in the order of `matrix['taxa']`)
+    # of p-distances, or of the number of differences with `hamming`; pairs
+    # without any site in common get a distance of None
+    taxa = matrix['taxa']
+    masks = taxon_masks(matrix, missing, gaps)
+
+    ret = [[0] * len(taxa) for _ in taxa]
+    for i, taxon_a in enumerate(taxa):
+        for j in range(i+1, len(taxa)):
+            compared, diffs = pair_counts(masks[taxon_a], masks[taxa[j]])
+            if hamming:
+                dist = diffs
+            elif compared:
+                dist = diffs / compared
+            else:
+                logging.warning('No sites in common for %s and %s',
+                    taxon_a, taxa[j])
+                dist = None
+            ret[i][j] = ret[j][i] = dist
+
+    return ret
+
+def char_groups(matrix):
+    # indices of the characters of each cantica (the first field of the
+    # labels, as in 'I_01_001_0'), in order of first occurrence
+    ret = {}
+    for c_idx, label in enumerate(matrix['chars']):
+        ret.setdefault(label.split('_', 1)[0], []).append(c_idx)
+
+    return ret
+
+def cantica_distances(matrix, **options):
+    # distance matrix of each cantica, as a dictionary
+    return dict((cantica, distance_matrix(charmatrix.subset(matrix,
+        char_indices=indices), **options))
+        for cantica, indices in char_groups(matrix).items())
+
+def window_distances(matrix, size, step=None, **options):
+    # yield (start, end, distances) for windows of `size` consecutive
+    # characters, moved by `step` characters (by default, not overlapping)
+    step = step or size
+    n_chars = len(matrix['chars'])
+    for start in range(0, max(n_chars - size, 0) + 1, step):
+        end = min(start + size, n_chars)
+        yield start, end, distance_matrix(charmatrix.subset(matrix,
+            char_indices=range(start, end)), **options)
+
+# matrix and options of the bootstrap workers, set by `_init_bootstrap()`
+_bootstrap_data = {}
+
+def _init_bootstrap(matrix, options):
+    _bootstrap_data['matrix'] = matrix
+    _bootstrap_data['options'] = options
+
+def _bootstrap_replicate(seed):
+    # distance matrix of a resampling (with replacement) of the characters
+    matrix = _bootstrap_data['matrix']
+    n_chars = len(matrix['chars'])
+    rng = random.Random(seed)
+    sample = [rng.randrange(n_chars) for _ in range(n_chars)]
+
+    return distance_matrix(charmatrix.subset(matrix, char_indices=sample),
+        **_bootstrap_data['options'])
+
+def bootstrap(matrix, replicates=100, seed=0, processes=None, chunksize=4,
+    **options):
+    # list of the distance matrices of `replicates` bootstrap resamplings,
+    # computed by a pool of `processes` workers (all cpus by default, no
+    # pool if 1); each replicate has its own seed, so that the results do
+    # not depend on the number of processes
+    seeds = [seed + rep for rep in range(replicates)]
+    if processes == 1 or replicates < 2:
+        _init_bootstrap(matrix, options)
+        return list(map(_bootstrap_replicate, seeds))
+
+    with multiprocessing.Pool(processes, _init_bootstrap,
+        (matrix, options)) as pool:
+        return list(pool.imap(_bootstrap_replicate, seeds, chunksize))
+
+def output_distances(taxa, distances, out_file):
+    # NEXUS file with a DISTANCES block (full square matrix), as read by
+    # SplitsTree and similar tools; pairs without distance are missing data
+    with open(out_file, 'w') as handler:
+        handler.write('#NEXUS\n\n')
+        handler.write('BEGIN TAXA;\n')
+        handler.write('\tDIMENSIONS NTAX=%i;\n' % len(taxa))
+        handler.write('\tTAXLABELS %s;\n' % ' '.join(taxa))
+        handler.write('END;\n\n')
+
+        handler.write('BEGIN DISTANCES;\n')
+        handler.write('\tFORMAT TRIANGLE=BOTH DIAGONAL LABELS MISSING=?;\n')
+        handler.write('\tMATRIX\n')
+        for taxon, row in zip(taxa, distances):
+            handler.write('\t%s %s\n' % (taxon, ' '.join([
+                '?' if dist is None else '%.6f' % dist for dist in row])))
+        handler.write('\t;\n')
+        handler.write('END;\n')
+
+def main():
+    # p-distances of the full matrix and of each cantica
+    matrix = nexusio.read_matrix('data/tresoldi.nex')
+    output_distances(matrix['taxa'], distance_matrix(matrix),
+        'data/tresoldi.dist.nex')
+
+    for cantica, distances in cantica_distances(matrix).items():
+        output_distances(matrix['taxa'], distances,
+            'data/tresoldi.%s.dist.nex' % cantica)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Opt-in instrumentation of the NEXUS pipeline: wall and CPU timers for
+# named stages, counters, peak memory, and a JSON report.
+#
+# Nothing is collected until `enable()` is called, and `stage()` and
+# `count()` are cheap no-ops otherwise. Warnings issued with `warning()`
+# are always aggregated by key: only the first few of each key are logged,
+# and the total is reported by `flush_warnings()` (and in the report), so
+# that per-cell warnings such as those for missing data do not flood the
+# log. Worker processes, started with `init_worker()`, send their stage
+# timings, counters and warnings to the parent with `totals()`, to be added
+# with `merge()`, so that the stages of a parallel run are the sums over
+# all processes (and their wall time can exceed that of the run).
+
+import collections
+import contextlib
+import json
+import logging
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# number of warnings logged for each key before suppressing them
+MAX_WARNINGS = 10
+
+_state = {
+    'enabled' : False,
+    'started' : None,
+    'stages' : {},
+    'counters' : collections.Counter(),
+    'warnings' : collections.Counter(),
+    'logged' : collections.Counter(),
+}
+
+def enable():
+    # start collecting, discarding any previous data
+    _state['enabled'] = True
+    _state['started'] = time.perf_counter()
+    _state['stages'] = {}
+    _state['counters'] = collections.Counter()
+    _state['warnings'] = collections.Counter()
+    _state['logged'] = collections.Counter()
+
+def init_worker(enabled):
+    # initializer of pool workers, collecting if `enabled` (i.e., if the
+    # parent is); any data inherited from the parent is discarded, so that
+    # it is not sent back with `totals()`
+    enable()
+    if not enabled:
+        disable()
+
+def disable():
+    _state['enabled'] = False
+
+def enabled():
+    return _state['enabled']
+
+@contextlib.contextmanager
+def stage(name):
+    # accumulate the wall and CPU time of the enclosed code under `name`;
+    # stages can be nested, with the time of the inner ones also counted
+    # in the outer ones
+    if not _state['enabled']:
+        yield
+        return
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        stats = _state['stages'].setdefault(name,
+            {'calls' : 0, 'wall' : 0.0, 'cpu' : 0.0})
+        stats['calls'] += 1
+        stats['wall'] += time.perf_counter() - wall
+        stats['cpu'] += time.process_time() - cpu
+
+def count(name, num=1):
+    if _state['enabled']:
+        _state['counters'][name] += num
+
+def warning(key, msg, *args):
+    # log a warning, as `logging.warning(key + ': ' + msg, *args)`, unless
+    # more than MAX_WARNINGS were already issued for the same key
+    _state['warnings'][key] += 1
+    num = _state['warnings'][key]
+    if num <= MAX_WARNINGS:
+        logging.warning('%s: ' + msg, key, *args)
+        _state['logged'][key] += 1
+    if num == MAX_WARNINGS:
+        logging.warning('%s: further warnings suppressed', key)
+
+def flush_warnings():
+    # log the number of suppressed warnings of each key, and reset them
+    for key, num in sorted(_state['warnings'].items()):
+        if num > _state['logged'][key]:
+            logging.warning('%s: %i warnings (%i suppressed)', key, num,
+                num - _state['logged'][key])
+    _state['warnings'] = collections.Counter()
+    _state['logged'] = collections.Counter()
+
+def totals():
+    # stage timings, warnings (issued and logged) and counters collected by
+    # this process since the last call, which are reset, so that a worker
+    # process can send them to the parent after each task
+    ret = {
+        'stages' : _state['stages'],
+        'warnings' : dict(_state['warnings']),
+        'logged' : dict(_state['logged']),
+        'counters' : dict(_state['counters']),
+    }
+    _state['stages'] = {}
+    _state['warnings'] = collections.Counter()
+    _state['logged'] = collections.Counter()
+    _state['counters'] = collections.Counter()
+
+    return ret
+
+def merge(data):
+    # add the `totals()` of another process
+    _state['warnings'].update(data['warnings'])
+    _state['logged'].update(data['logged'])
+    if _state['enabled']:
+        _state['counters'].update(data['counters'])
+        for name, stats in data['stages'].items():
+            total = _state['stages'].setdefault(name,
+                {'calls' : 0, 'wall' : 0.0, 'cpu' : 0.0})
+            for key in total:
+                total[key] += stats[key]
+
+def peak_memory():
+    # peak resident memory of the process (and of its finished children,
+    # such as pool workers), in kilobytes, or None if not available
+    if resource is None:
+        return None
+
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def report():
+    # all the collected data, as a dictionary
+    return {
+        'wall' : (time.perf_counter() - _state['started']
+            if _state['started'] is not None else None),
+        'stages' : dict((name, dict(stats))
+            for name, stats in _state['stages'].items()),
+        'counters' : dict(_state['counters']),
+        'warnings' : dict(_state['warnings']),
+        'peak_memory_kb' : peak_memory(),
+    }
+
+def write_report(filename, extra=None):
+    # write the report as JSON, with any `extra` entries
+    data = report()
+    if extra:
+        data.update(extra)
+
+    with open(filename, 'w') as handler:
+        json.dump(data, handler, indent=2, sort_keys=True)
+        handler.write('\n')
@@ -3,6 +3,17 @@
 
 # quick and dirty script to find the groups of continuous cantos with more
 # or less changes in the tradition, according to Barbi's loci
+#
+# The same analysis can be run on the real character matrix: statistics are
+# collected once per canto (number of informative sites, disagreements of
+# each witness with the majority reading, and compared and differing sites
+# of each pair of witnesses) and turned into prefix sums, so that the
+# statistics of any window of consecutive cantos are computed in constant
+# time, for windows of any span.
+
+import charmatrix
+import distances
+import nexusio
 
 SPAN = 6
 
@@ -25,8 +36,145 @@ barbi = {
         7, 1, 8],
 }
 
-for cantica in sorted(barbi):
-    for i in range(len(barbi[cantica])-SPAN+1):
-        num_loci = sum(barbi[cantica][i:i+SPAN])
-        print(cantica, i, i+SPAN, barbi[cantica][i:i+SPAN], num_loci)
+def prefix_sums(values):
+    # cumulative sums with a leading zero, so that the sum of
+    # `values[start:end]` is `sums[end] - sums[start]`
+    sums = [0]
+    for value in values:
+        sums.append(sums[-1] + value)
+
+    return sums
+
+def canto_chars(matrix):
+    # indices of the characters of each canto, as a list of ((cantica,
+    # canto), indices) in order of first occurrence; labels are as in
+    # 'I_01_001_0'
+    cantos = {}
+    for c_idx, label in enumerate(matrix['chars']):
+        cantica, canto = label.split('_')[:2]
+        cantos.setdefault((cantica, int(canto)), []).append(c_idx)
+
+    return list(cantos.items())
+
+def column_stats(column):
+    # (informative, index of the witnesses disagreeing with the majority)
+    # for a column of codes; gaps and missing data are not counted, and a
+    # site is informative if at least two states are found in at least two
+    # witnesses each
+    counts = {}
+    for code in column:
+        if code not in (charmatrix.GAP, charmatrix.MISSING):
+            counts[code] = counts.get(code, 0) + 1
+    if len(counts) < 2:
+        return False, []
+
+    informative = len([n for n in counts.values() if n > 1]) > 1
+    majority = max(counts, key=counts.get)
+    return informative, [t_idx for t_idx, code in enumerate(column)
+        if code not in (charmatrix.GAP, charmatrix.MISSING, majority)]
+
+def canto_profile(matrix, missing=distances.IGNORE, gaps=distances.IGNORE):
+    # statistics of each canto, in order: number of `informative` sites,
+    # `disagreements` of each witness with the majority, and the
+    # `compared` and `diffs` sites of each pair of witnesses (as a
+    # dictionary with pairs in the order of `matrix['taxa']`)
+    taxa = matrix['taxa']
+    pairs = [(a, b) for i, a in enumerate(taxa) for b in taxa[i+1:]]
+    ret = {
+        'cantos' : [],
+        'informative' : [],
+        'disagreements' : dict((taxon, []) for taxon in taxa),
+        'compared' : dict((pair, []) for pair in pairs),
+        'diffs' : dict((pair, []) for pair in pairs),
+    }
+
+    for canto, indices in canto_chars(matrix):
+        canto_matrix = charmatrix.subset(matrix, char_indices=indices)
+        informative = 0
+        disagreements = [0] * len(taxa)
+        for column in zip(*[canto_matrix['rows'][taxon] for taxon in taxa]):
+            is_informative, disagreeing = column_stats(column)
+            informative += is_informative
+            for t_idx in disagreeing:
+                disagreements[t_idx] += 1
+
+        ret['cantos'].append(canto)
+        ret['informative'].append(informative)
+        for taxon, count in zip(taxa, disagreements):
+            ret['disagreements'][taxon].append(count)
+
+        masks = distances.taxon_masks(canto_matrix, missing, gaps)
+        for pair in pairs:
+            compared, diffs = distances.pair_counts(masks[pair[0]],
+                masks[pair[1]])
+            ret['compared'][pair].append(compared)
+            ret['diffs'][pair].append(diffs)
+
+    return ret
+
+def window_index(profile):
+    # prefix sums of all the statistics of a canto profile
+    return {
+        'cantos' : profile['cantos'],
+        'informative' : prefix_sums(profile['informative']),
+        'disagreements' : dict((taxon, prefix_sums(values))
+            for taxon, values in profile['disagreements'].items()),
+        'compared' : dict((pair, prefix_sums(values))
+            for pair, values in profile['compared'].items()),
+        'diffs' : dict((pair, prefix_sums(values))
+            for pair, values in profile['diffs'].items()),
+    }
+
+def window(index, start, end):
+    # statistics of the cantos `index['cantos'][start:end]`, with the
+    # p-distance of each pair of witnesses (None if no site was compared)
+    ret = {
+        'cantos' : index['cantos'][start:end],
+        'informative' : index['informative'][end] -
+            index['informative'][start],
+        'disagreements' : dict((taxon, sums[end] - sums[start])
+            for taxon, sums in index['disagreements'].items()),
+        'distances' : {},
+    }
+
+    for pair, sums in index['compared'].items():
+        compared = sums[end] - sums[start]
+        diffs = index['diffs'][pair][end] - index['diffs'][pair][start]
+        ret['distances'][pair] = diffs / compared if compared else None
+
+    return ret
+
+def iter_windows(index, span):
+    # yield the statistics of all windows of `span` consecutive cantos,
+    # without crossing the boundaries of cantiche
+    cantos = index['cantos']
+    for start in range(len(cantos)-span+1):
+        end = start + span
+        if cantos[start][0] == cantos[end-1][0]:
+            yield window(index, start, end)
+
+def barbi_windows(span=SPAN):
+    # yield (cantica, start, end, loci, sum) for the windows of Barbi's
+    # loci, with the same prefix sums used for the matrix
+    for cantica in sorted(barbi):
+        sums = prefix_sums(barbi[cantica])
+        for i in range(len(barbi[cantica])-span+1):
+            yield (cantica, i, i+span, barbi[cantica][i:i+span],
+                sums[i+span] - sums[i])
+
+def main():
+    for cantica, start, end, loci, num_loci in barbi_windows():
+        print(cantica, start, end, loci, num_loci)
+
+def matrix_main(filename='data/tresoldi_red.nex', span=SPAN):
+    # informative sites and most divergent witness of each window of the
+    # real matrix
+    index = window_index(canto_profile(nexusio.read_matrix(filename)))
+    for stats in iter_windows(index, span):
+        first, last = stats['cantos'][0], stats['cantos'][-1]
+        taxon = max(stats['disagreements'], key=stats['disagreements'].get)
+        print(first[0], first[1], last[1], stats['informative'], taxon,
+            stats['disagreements'][taxon])
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Exact maximum parsimony search by branch and bound, for small sets of
+# witnesses such as those of the reduced matrices (`tresoldi_red.nex` and
+# its per-cantica versions), without shipping the data to PAUP or TNT.
+#
+# Trees are built by stepwise addition of the taxa, in the order of the
+# matrix, to every branch of the unrooted trees of the previous ones; as
+# adding a taxon never makes a tree shorter, partial trees longer than the
+# best complete tree found so far are discarded with all their descendants.
+# Lengths are computed with the bit-parallel Fitch algorithm of `parsimony`
+# on the weighted site patterns (dropping the invariant ones, which never
+# require changes). The search starts from the length of a greedy
+# stepwise-addition tree, and the partial trees of the first levels (the
+# frontier) are searched by a pool of workers, sharing the best length.
+#
+# Partial trees are nested tuples of taxon indices, rooted on the first
+# taxon: `(1, (2, 3))` stands for the unrooted tree of taxa 0 to 3 with
+# taxon 0 attached to the root of the tuple.
+
+import multiprocessing
+
+import charmatrix
+import newick
+import nexusio
+import parsimony
+import treebuild
+
+# minimum number of partial trees in the frontier shared by the workers
+FRONTIER_SIZE = 64
+
+def search_data(matrix):
+    # leaf state sets and weight planes of the informative site patterns
+    patterns = charmatrix.compress_patterns(matrix, drop_invariant=True)
+    leaves = parsimony.leaf_sets(patterns)
+
+    return {
+        'taxa' : list(matrix['taxa']),
+        'leaves' : [leaves[taxon] for taxon in matrix['taxa']],
+        'planes' : parsimony.weight_planes(patterns['weights']),
+    }
+
+def _down(node, data):
+    # Fitch state sets and length of a (partial) subtree
+    if isinstance(node, int):
+        return data['leaves'][node], 0
+
+    sets_a, length_a = _down(node[0], data)
+    sets_b, length_b = _down(node[1], data)
+    sets, changes = parsimony.fitch_join(sets_a, sets_b)
+
+    return sets, (length_a + length_b +
+        parsimony.weighted_count(changes, data['planes']))
+
+def tree_length(subtree, data):
+    # parsimony length of the unrooted tree with taxon 0 attached to the
+    # root of `subtree`
+    sets, length = _down(subtree, data)
+    _, changes = parsimony.fitch_join(sets, data['leaves'][0])
+
+    return length + parsimony.weighted_count(changes, data['planes'])
+
+def insertions(subtree, taxon):
+    # yield the subtrees with `taxon` added to every branch of `subtree`
+    yield (subtree, taxon)
+    if not isinstance(subtree, int):
+        for child in insertions(subtree[0], taxon):
+            yield (child, subtree[1])
+        for child in insertions(subtree[1], taxon):
+            yield (subtree[0], child)
+
+def greedy_tree(data):
+    # (length, subtree) of a tree built by adding each taxon to the branch
+    # giving the shortest tree
+    subtree = (1, 2)
+    for taxon in range(3, len(data['taxa'])):
+        subtree = min(insertions(subtree, taxon),
+            key=lambda candidate: tree_length(candidate, data))
+
+    return tree_length(subtree, data), subtree
+
+# search data and shared best length of the workers, set by `_init_search()`
+_search = {}
+
+def _init_search(data, bound):
+    _search['data'] = data
+    _search['bound'] = bound
+
+def _branch(subtree, taxon, found):
+    # depth-first search from a partial tree, to which `taxon` is the next
+    # taxon to add, collecting the complete trees no longer than the best
+    # length in `found`, as (length, subtree)
+    data = _search['data']
+    bound = _search['bound']
+    length = tree_length(subtree, data)
+    if length > bound.value:
+        return
+
+    if taxon == len(data['taxa']):
+        with bound.get_lock():
+            if length < bound.value:
+                bound.value = length
+        found.append((length, subtree))
+        return
+
+    for candidate in insertions(subtree, taxon):
+        _branch(candidate, taxon+1, found)
+
+def _search_frontier(item):
+    # search all the trees descending from a partial tree, in a worker
+    found = []
+    _branch(item[0], item[1], found)
+
+    return found
+
+def frontier(data, bound, size=FRONTIER_SIZE):
+    # list of the (subtree, next taxon) partial trees of the first level
+    # of the search with at least `size` trees, within the bound
+    n_taxa = len(data['taxa'])
+    level = [((1, 2), 3)]
+    while len(level) < size and level[0][1] < n_taxa:
+        level = [(candidate, taxon+1) for subtree, taxon in level
+            for candidate in insertions(subtree, taxon)
+            if tree_length(candidate, data) <= bound]
+
+    return level
+
+def to_tree(subtree, taxa):
+    # Newick root node of an unrooted tree, with the first taxon at the
+    # root trifurcation
+    def _node(node):
+        if isinstance(node, int):
+            return newick.new_node(taxa[node])
+        return newick.new_node(children=[_node(child) for child in node])
+
+    root = _node(subtree)
+    root['children'].insert(0, newick.new_node(taxa[0]))
+
+    return root
+
+def branch_and_bound(matrix, processes=None):
+    # (length, trees) of all the most parsimonious unrooted trees for
+    # `matrix`, as Newick root nodes; the frontier is searched by a pool of
+    # `processes` workers (all cpus by default, no pool if 1)
+    data = search_data(matrix)
+    taxa = [taxon.replace('-', '_') for taxon in data['taxa']]
+    if len(taxa) < 4:
+        return tree_length((1, 2) if len(taxa) == 3 else 1, data), [
+            newick.new_node(children=[newick.new_node(t) for t in taxa])]
+
+    best, _ = greedy_tree(data)
+    bound = multiprocessing.Value('q', best)
+    items = frontier(data, best)
+
+    if processes == 1 or len(items) < 2:
+        _init_search(data, bound)
+        results = map(_search_frontier, items)
+        found = [tree for trees in results for tree in trees]
+    else:
+        with multiprocessing.Pool(processes, _init_search,
+            (data, bound)) as pool:
+            found = [tree for trees in
+                pool.imap_unordered(_search_frontier, items) for tree in trees]
+
+    # trees found before the best length was lowered are discarded
+    length = min([length for length, _ in found])
+    trees = sorted([subtree for l, subtree in found if l == length], key=str)
+
+    return length, [to_tree(subtree, taxa) for subtree in trees]
+
+def main():
+    # most parsimonious trees of the reduced matrix and of each cantica
+    for suffix in ['', '.I', '.P', '.Z']:
+        filename = 'data/tresoldi_red%s.nex' % suffix
+        length, trees = branch_and_bound(nexusio.read_matrix(filename))
+        print(filename, 'length', length, 'trees', len(trees))
+        print(treebuild.trees_block([('MP%i' % (idx+1), tree)
+            for idx, tree in enumerate(trees)]))
+
+if __name__ == '__main__':
+    main()
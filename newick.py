@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Minimal Newick reading and writing, for the trees we embed in the NEXUS
+# files (e.g., the 'Tresoldi' and 'MLConsensus' trees in `tonexus()`).
+#
+# A tree is represented by its root node, with each node being a
+# dictionary with a `name` (None for unlabelled internal nodes; for internal
+# nodes this is usually a support value), a branch `length` (None if not
+# given), and a list of `children` (empty for leaves).
+
+def new_node(name=None, length=None, children=None):
+    return {
+        'name' : name,
+        'length' : length,
+        'children' : children or [],
+    }
+
+def _tokenize(text):
+    # split a Newick string into punctuation and labels, dropping comments
+    # (such as '[&R]') and whitespace outside quoted labels
+    tokens = []
+    idx = 0
+    while idx < len(text):
+        char = text[idx]
+        if char in '(),:;':
+            tokens.append(char)
+            idx += 1
+        elif char == '[':
+            idx = text.index(']', idx) + 1
+        elif char.isspace():
+            idx += 1
+        elif char == "'":
+            # quoted label, with doubled quotes for literal ones
+            end = idx + 1
+            label = ''
+            while True:
+                end = text.index("'", end)
+                label += text[idx+1:end]
+                if text[end+1:end+2] == "'":
+                    label += "'"
+                    idx = end + 1
+                    end += 2
+                else:
+                    break
+            tokens.append(('label', label))
+            idx = end + 1
+        else:
+            end = idx
+            while end < len(text) and text[end] not in "(),:;[' \t\n\r":
+                end += 1
+            # unquoted underscores stand for blanks, but we keep them as
+            # they are, as our taxon labels use them (e.g., 'Mart_c2')
+            tokens.append(('label', text[idx:end]))
+            idx = end
+
+    return tokens
+
+def _parse_node(tokens, idx):
+    # parse the node starting at `tokens[idx]`, returning it and the index
+    # of the first token after it
+    node = new_node()
+
+    if tokens[idx] == '(':
+        while True:
+            child, idx = _parse_node(tokens, idx+1)
+            node['children'].append(child)
+            if tokens[idx] == ')':
+                idx += 1
+                break
+            if tokens[idx] != ',':
+                raise ValueError('unexpected token in Newick: %s' %
+                    (tokens[idx],))
+
+    if idx < len(tokens) and isinstance(tokens[idx], tuple):
+        node['name'] = tokens[idx][1]
+        idx += 1
+
+    if idx < len(tokens) and tokens[idx] == ':':
+        node['length'] = float(tokens[idx+1][1])
+        idx += 2
+
+    return node, idx
+
+def parse_newick(text):
+    # parse a single Newick tree, returning its root node
+    tokens = _tokenize(text)
+    root, idx = _parse_node(tokens, 0)
+    if tokens[idx:] not in ([], [';']):
+        raise ValueError('trailing data in Newick string')
+
+    return root
+
+def to_newick(node, lengths=True):
+    # serialize a tree (or subtree), with a final semicolon
+    return _to_newick(node, lengths) + ';'
+
+def _to_newick(node, lengths):
+    buf = ''
+    if node['children']:
+        buf = '(%s)' % ','.join([_to_newick(child, lengths)
+            for child in node['children']])
+
+    if node['name'] is not None:
+        name = node['name']
+        if set(name) & set("(),:;[]' \t"):
+            name = "'%s'" % name.replace("'", "''")
+        buf += name
+
+    if lengths and node['length'] is not None:
+        buf += ':%.10f' % node['length']
+
+    return buf
+
+def postorder(node):
+    # iterate over all nodes, children before parents
+    for child in node['children']:
+        yield from postorder(child)
+    yield node
+
+def preorder(node):
+    # iterate over all nodes, parents before children
+    yield node
+    for child in node['children']:
+        yield from preorder(child)
+
+def leaf_names(node):
+    return [n['name'] for n in postorder(node) if not n['children']]
@@ -4,42 +4,93 @@
 A quick&dirty script to convert the NEXUS data to a CSV format.
 
 This allows to play with BEASTling and inspect with more ease.
+
+The long `Language_ID/Feature_ID/Value` table is streamed from the NEXUS
+matrix and written in large buffered chunks; it can optionally skip the
+invariant features and also be written as a Parquet file, if `pyarrow` is
+installed.
 """
 
-def main():
-    # Read the entire contents as lines
-    filename = "data/tresoldi.nex"
-    with open(filename) as handler:
-        lines = [line.strip() for line in handler]
-
-    # Collect char state labels
-    labels_start = ["CHARSTATELABELS" in line for line in lines]
-    line_idx = labels_start.index(True) + 1
-    labels = []
-    while True:
-        fields = lines[line_idx].strip().split()
-        if fields[0] == ";":
-            break
-
-        labels.append(fields[1])
-        line_idx += 1
-
-    # identify where the matrix starts and collect the vectors, char
-    # lists are separated by two spaces
-    matrix_start = ["MATRIX" in line for line in lines]
-    vectors = lines[matrix_start.index(True)+1:-2]
-
-    with open("beast/dante_chars.csv", "w") as handler:
+import nexusio
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# symbols which do not count as states when looking for invariant features
+UNKNOWN_SYMBOLS = '?-'
+
+def main(in_file="data/tresoldi.nex", out_file="beast/dante_chars.csv",
+    skip_invariant=False, parquet_file=None):
+    # Collect char state labels, and stream the matrix rows from the file;
+    # `out_file` is the file used by the `data` of `beast/dante.conf`
+    labels = [label for _, label, _ in nexusio.iter_charstatelabels(in_file)]
+
+    keep = None
+    if skip_invariant:
+        keep = variant_features(nexusio.iter_matrix(in_file))
+
+    output_csv(labels, nexusio.iter_matrix(in_file), out_file, keep)
+    if parquet_file:
+        output_parquet(labels, nexusio.iter_matrix(in_file), parquet_file,
+            keep)
+
+def variant_features(rows):
+    # indices of the features with at least two states (gaps and missing
+    # data excluded), from a first pass over the rows
+    states = None
+    for taxon, values in rows:
+        if states is None:
+            states = [set() for _ in values]
+        for c_idx, value in enumerate(values):
+            if value not in UNKNOWN_SYMBOLS:
+                states[c_idx].add(value)
+
+    return [c_idx for c_idx, symbols in enumerate(states or [])
+        if len(symbols) > 1]
+
+def _long_rows(labels, rows, keep):
+    # yield (taxon label, [(feature, value), ...]) for each row
+    if keep is not None:
+        labels = [labels[c_idx] for c_idx in keep]
+
+    for taxon, values in rows:
+        if keep is not None:
+            values = [values[c_idx] for c_idx in keep]
+        yield taxon.replace("-", "_"), zip(labels, values)
+
+def output_csv(labels, rows, out_file, keep=None):
+    # long format, with one line per taxon and feature, from an iterable of
+    # (taxon, symbols) rows, such as `charmatrix.iter_rows()`; the lines for
+    # each taxon are built and written in a single call, to the buffered
+    # (and, for '.gz' or '.zst' names, compressed) writer of `nexusio`; if
+    # given, only the features in `keep` (indices) are written
+    with nexusio.open_output(out_file) as handler:
         handler.write("Language_ID\tFeature_ID\tValue\n")
 
-        for vector in vectors:
-            if not " " in vector:
-                continue
+        for taxon_label, features in _long_rows(labels, rows, keep):
+            handler.write("".join(["%s\t%s\t%s\n" % (taxon_label, label, value)
+                for label, value in features]))
+
+def output_parquet(labels, rows, out_file, keep=None):
+    # same table as `output_csv()`, as a Parquet file with one row group
+    # for each taxon
+    if pyarrow is None:
+        raise RuntimeError("pyarrow is needed for Parquet output")
+
+    schema = pyarrow.schema([("Language_ID", pyarrow.string()),
+        ("Feature_ID", pyarrow.string()), ("Value", pyarrow.string())])
 
-            taxon, chars = vector.split(" ", 1)
-            chars = chars[1:]
-            for char_label, char_value in zip(labels, chars):
-                handler.write("%s\t%s\t%s\n" % (taxon, char_label, char_value))
+    with pyarrow.parquet.ParquetWriter(out_file, schema) as writer:
+        for taxon_label, features in _long_rows(labels, rows, keep):
+            features = list(features)
+            writer.write_table(pyarrow.table({
+                "Language_ID" : [taxon_label] * len(features),
+                "Feature_ID" : [label for label, _ in features],
+                "Value" : [value for _, value in features],
+            }, schema=schema))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Streaming NEXUS reader, shared by the scripts of this repository.
+#
+# Files are read line by line, and `iter_nexus()` yields the contents of the
+# commands we use (TAXLABELS, CHARSTATELABELS, MATRIX, TREE, etc.) together
+# with the block they are in, without comments, so that the functions below
+# can stream taxa, state labels, matrix rows and trees as generators with
+# bounded memory. Taxa, characters and matrices are only taken from TAXA,
+# CHARACTERS and DATA blocks, and trees from TREES blocks, so that the
+# matrices of other blocks (such as SplitsTree's Splits) are ignored;
+# quoted labels are unquoted, and the leaves of trees are renamed by
+# `read_trees()` after the TRANSLATE command of their block (as in BEAST
+# files). Interleaved matrices (the same taxon in more than one row) are
+# merged by `read_matrix()`, and Shaw's "transposed" files, with loci
+# stored as taxa, can be read with `transposed=True`.
+#
+# Output files are written with `open_output()`, which buffers the text in
+# large blocks, compresses it according to the extension ('.gz', or '.zst'
+# if `zstandard` is installed), and writes to a temporary file that replaces
+# the output only when complete, so that a crash never leaves a partial
+# file behind.
+
+import contextlib
+import gzip
+import io
+import logging
+import os
+import re
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import charmatrix
+import newick
+
+# commands whose contents span many lines, until a semicolon; Shaw's files
+# use STATELABELS for the labels of loci
+SECTIONS = ['DIMENSIONS', 'TAXLABELS', 'CHARSTATELABELS', 'STATELABELS',
+    'CHARLABELS', 'MATRIX', 'TRANSLATE', 'TREE', 'WTSET']
+
+# sections whose comments are kept, as the state labels written by
+# `transcription2nexus` use brackets for abbreviations, as in "dir_[et]"
+RAW_SECTIONS = ['CHARSTATELABELS', 'STATELABELS']
+
+# blocks with taxa, characters and matrices, and with trees
+DATA_BLOCKS = ['TAXA', 'CHARACTERS', 'DATA']
+TREE_BLOCKS = ['TREES']
+
+# a (possibly quoted) label, with doubled quotes within quoted ones
+LABEL_RE = re.compile(r"'(?:[^']|'')*'|[^\s']+")
+
+# counts of the DIMENSIONS command, e.g. "NTAX=8" or "NCHAR=94782"
+DIMENSION_RE = re.compile(r'\b(NTAX|NCHAR)\s*=\s*(\d+)', re.IGNORECASE)
+
+# tree commands in TREES blocks, e.g. "[1] tree 'Tresoldi'=[&R] (...);"
+TREE_RE = re.compile(r"^\s*(?:\[[^\]]*\]\s*)?tree\s+('(?:[^']|'')*'|[^\s=]+)"
+    r"\s*=\s*(?:\[&[RrUu]\]\s*)?(.*;)", re.IGNORECASE)
+
+# (token, label) pairs of TRANSLATE commands, e.g. "1 Ash, 2 'Mart c2',"
+TRANSLATE_RE = re.compile(r"([^\s,']+)\s+('(?:[^']|'')*'|[^\s,']+)")
+
+# size, in bytes, of the blocks written by `open_output()`
+BUFFER_SIZE = 1 << 20
+
+@contextlib.contextmanager
+def open_output(filename, buffer_size=BUFFER_SIZE):
+    # context manager returning a text handler for `filename`, buffered in
+    # blocks of `buffer_size` bytes and compressed when the name ends in
+    # '.gz' or '.zst'; the file is only replaced if the block exits without
+    # errors
+    if filename.endswith('.zst') and zstandard is None:
+        raise RuntimeError('zstandard is needed for .zst output')
+
+    tmp_file = '%s.%i.tmp' % (filename, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as raw:
+            if filename.endswith('.gz'):
+                stream = gzip.GzipFile(os.path.basename(filename[:-3]), 'wb',
+                    6, raw, mtime=0)
+            elif filename.endswith('.zst'):
+                stream = zstandard.ZstdCompressor().stream_writer(raw,
+                    closefd=False)
+            else:
+                stream = raw
+
+            handler = io.TextIOWrapper(io.BufferedWriter(stream, buffer_size),
+                encoding='utf-8', newline='')
+            yield handler
+            handler.close()
+        os.replace(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def _strip_comments(line, depth):
+    # `line` without comments (which can be nested, and span many lines),
+    # and the depth of the comments still open at its end; brackets within
+    # quoted labels are not comments
+    if depth == 0 and '[' not in line:
+        return line, 0
+
+    buf = []
+    quoted = False
+    for char in line:
+        if depth:
+            if char == '[':
+                depth += 1
+            elif char == ']':
+                depth -= 1
+        elif char == '[' and not quoted:
+            depth = 1
+        else:
+            if char == "'":
+                quoted = not quoted
+            buf.append(char)
+
+    return ''.join(buf), depth
+
+def unquote(label):
+    # a NEXUS label without its quotes, if any
+    if len(label) > 1 and label[0] == label[-1] == "'":
+        return label[1:-1].replace("''", "'")
+
+    return label
+
+def iter_nexus(filename):
+    # yield (block, section, line) for each non-empty line within a section,
+    # with blocks and sections in upper case and comments removed (except
+    # in RAW_SECTIONS); the line opening a section is also yielded if it has
+    # contents after the command name (e.g., "TAXLABELS Ash Ham;"), and the
+    # final semicolon of a section is removed; the start of each block is
+    # yielded as (block, 'BEGIN', line), so that the commands of a block
+    # (such as TRANSLATE) are not applied to the next one
+    logging.info("Parsing %s...", filename)
+
+    block = None
+    section = None
+    depth = 0
+    with open(filename) as nexus:
+        for line in nexus:
+            if section not in RAW_SECTIONS:
+                line, depth = _strip_comments(line, depth)
+            line = line.strip()
+            if not line:
+                continue
+            upper = line.upper()
+
+            if upper.startswith('BEGIN '):
+                block = upper[6:].rstrip(';').strip()
+                section = None
+                yield block, 'BEGIN', line
+                continue
+            if upper in ['END;', 'ENDBLOCK;', 'END', 'ENDBLOCK']:
+                block = None
+                section = None
+                continue
+
+            # start of a section, either by itself or with contents
+            command = upper.split(None, 1)[0].rstrip(';')
+            if command in SECTIONS:
+                section = command
+                if command == 'TREE':
+                    # trees are a single command, with the command name
+                    yield block, section, line
+                    section = None
+                    continue
+                line = line[len(command):].strip()
+                if not line:
+                    continue
+            elif TREE_RE.match(line):
+                yield block, 'TREE', line
+                continue
+
+            if section is None:
+                continue
+
+            if line.endswith(';'):
+                line = line[:-1].strip()
+                if line:
+                    yield block, section, line
+                section = None
+            else:
+                yield block, section, line
+
+def _matrix_fields(line, skip_index):
+    # (name, symbols) of a matrix row, with the symbols without whitespace,
+    # or None for noisy lines
+    if skip_index:
+        fields = line.split(None, 1)
+        if len(fields) != 2:
+            return None
+        line = fields[1]
+
+    match = LABEL_RE.match(line)
+    symbols = ''.join(line[match.end():].split()) if match else ''
+    if not symbols:
+        return None
+
+    return unquote(match.group(0)), symbols
+
+def _charstatelabel(line):
+    # (number, label, state labels) of a CHARSTATELABELS entry
+    fields = [unquote(field) for field in line.rstrip(',').split()]
+    return int(fields[0]), fields[1], fields[3:]
+
+def iter_taxlabels(filename):
+    for block, section, line in iter_nexus(filename):
+        if section == 'TAXLABELS' and block in DATA_BLOCKS:
+            yield from [unquote(label) for label in LABEL_RE.findall(line)]
+
+def iter_charstatelabels(filename):
+    # yield (number, label, state labels) for each character, for entries
+    # such as "22 I_01_004_3 / dir_qual_era dire_qual_era ,"
+    for block, section, line in iter_nexus(filename):
+        if section == 'CHARSTATELABELS' and block in DATA_BLOCKS:
+            yield _charstatelabel(line)
+
+def iter_matrix(filename, skip_index=False):
+    # yield (name, symbols) for each row of the MATRIX; with `skip_index`,
+    # a leading row number (as in Shaw's files) is dropped
+    for block, section, line in iter_nexus(filename):
+        if section == 'MATRIX' and block in DATA_BLOCKS:
+            fields = _matrix_fields(line, skip_index)
+            if fields:
+                yield fields
+
+def iter_trees(filename, translations=False):
+    # yield (name, newick string) for all trees in the file; with
+    # `translations`, yield (name, newick string, translation) instead,
+    # where translation is the dictionary of the TRANSLATE command of the
+    # TREES block (as in BEAST files, whose leaves are numbers), empty if
+    # there is none; the leaves of the newick strings are not renamed
+    translation = {}
+    for block, section, line in iter_nexus(filename):
+        if block not in TREE_BLOCKS:
+            continue
+        if section == 'BEGIN':
+            translation = {}
+        elif section == 'TRANSLATE':
+            translation.update((token, unquote(label))
+                for token, label in TRANSLATE_RE.findall(line))
+        elif section == 'TREE':
+            match = TREE_RE.match(line)
+            if match:
+                if translations:
+                    yield unquote(match.group(1)), match.group(2), translation
+                else:
+                    yield unquote(match.group(1)), match.group(2)
+
+def read_matrix(filename, transposed=False, skip_index=False):
+    # read taxa, character and state labels, and the matrix rows; rows of
+    # interleaved matrices are concatenated; with `transposed`, the rows of
+    # the matrix are read as characters (columns) and the taxa as the
+    # witnesses of each column; with `skip_index`, the numbers of the
+    # matrix rows and of the taxa are dropped (as in Shaw's files); the
+    # number of characters is taken from DIMENSIONS, or else from the width
+    # of the rows, with characters without CHARSTATELABELS named after
+    # their number; a ValueError is raised if there is no matrix, or if its
+    # dimensions do not agree
+    dimensions = {}
+    taxa = []
+    labels = {}
+    rows = {}
+
+    for block, section, line in iter_nexus(filename):
+        if block not in DATA_BLOCKS:
+            continue
+        if section == 'DIMENSIONS':
+            dimensions.update((key.upper(), int(value))
+                for key, value in DIMENSION_RE.findall(line))
+        elif section == 'TAXLABELS':
+            taxa += [unquote(taxon) for taxon in LABEL_RE.findall(line)
+                if not (skip_index and taxon.isdigit())]
+        elif section == 'CHARSTATELABELS':
+            number, label, state_labels = _charstatelabel(line)
+            labels[number] = (label, state_labels)
+        elif section == 'MATRIX':
+            fields = _matrix_fields(line, skip_index)
+            if fields:
+                rows.setdefault(fields[0], []).append(fields[1])
+
+    if not rows:
+        raise ValueError('%s: no matrix in TAXA, CHARACTERS or DATA blocks'
+            % filename)
+    rows = dict((name, ''.join(chunks)) for name, chunks in rows.items())
+
+    if transposed:
+        # each row is a character, with one symbol per taxon
+        for label, symbols in rows.items():
+            if len(symbols) != len(taxa):
+                raise ValueError('%s: %s has %i symbols for %i taxa' % (
+                    filename, label, len(symbols), len(taxa)))
+        chars = list(rows)
+        state_labels = [[] for _ in chars]
+        matrix = charmatrix.new_matrix(taxa, chars, state_labels)
+        buf = charmatrix.encode_symbols(''.join(rows.values()))
+        for t_idx, taxon in enumerate(taxa):
+            matrix['rows'][taxon] = buf[t_idx::len(taxa)]
+
+        return matrix
+
+    # taxa are those of the rows, in order, when there are no TAXLABELS
+    if not taxa:
+        taxa = list(rows)
+    if 'NTAX' in dimensions and dimensions['NTAX'] != len(taxa):
+        raise ValueError('%s: NTAX=%i, but %i taxa' % (filename,
+            dimensions['NTAX'], len(taxa)))
+    if set(rows) != set(taxa):
+        raise ValueError('%s: the taxa of the matrix differ from TAXLABELS'
+            % filename)
+
+    n_chars = dimensions.get('NCHAR',
+        max([len(symbols) for symbols in rows.values()]))
+    for taxon, symbols in rows.items():
+        if len(symbols) != n_chars:
+            raise ValueError('%s: %s has %i symbols for %i characters' % (
+                filename, taxon, len(symbols), n_chars))
+
+    chars = [labels.get(idx+1, (str(idx+1), []))[0] for idx in range(n_chars)]
+    state_labels = [labels.get(idx+1, (None, []))[1]
+        for idx in range(n_chars)]
+    matrix = charmatrix.new_matrix(taxa, chars, state_labels)
+    for taxon, symbols in rows.items():
+        matrix['rows'][taxon] = charmatrix.encode_symbols(symbols)
+
+    return matrix
+
+def read_trees(filename):
+    # return a list of (name, root node) for all trees in the file, with
+    # the leaves renamed after the TRANSLATE command of their block, if any
+    trees = []
+    for name, text, translation in iter_trees(filename, True):
+        tree = newick.parse_newick(text)
+        if translation:
+            for node in newick.postorder(tree):
+                if not node['children'] and node['name'] in translation:
+                    node['name'] = translation[node['name']]
+        trees.append((name, tree))
+
+    return trees
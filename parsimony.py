@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Native parsimony and ancestral state reconstruction (ASR), replacing the
+# round-trip through Mesquite's "Trace All Characters".
+#
+# Tree lengths are computed with a bit-parallel Fitch algorithm (generalized
+# to polytomies by counting, for each state, the children including it in
+# their sets): for every node, each state is an integer whose bits are the
+# site patterns in which that state is in the node set. The sets of states
+# in any most parsimonious reconstruction (MPR) of every node are computed
+# with Sankoff's algorithm (unit costs) over the unique site patterns only,
+# and expanded back to the original characters.
+
+import charmatrix
+import newick
+import nexusio
+
+def node_names(tree):
+    # names of all nodes, in postorder; internal nodes are numbered in
+    # preorder as done by Mesquite, which starts from 2 at the root
+    numbers = {}
+    for idx, node in enumerate(newick.preorder(tree)):
+        numbers[id(node)] = idx + 2
+
+    return [node['name'] if not node['children'] else str(numbers[id(node)])
+        for node in newick.postorder(tree)]
+
+def weight_planes(weights):
+    # bit-sliced weights, so that the weighted count of the sites in a mask
+    # is the sum of the popcounts of the mask and each plane, shifted
+    planes = []
+    for bit in range(max(weights or [0]).bit_length()):
+        planes.append(sum([1 << i for i, w in enumerate(weights)
+            if w >> bit & 1]))
+
+    return planes
+
+def weighted_count(mask, planes):
+    if planes is None:
+        return mask.bit_count()
+
+    return sum([(mask & plane).bit_count() << bit
+        for bit, plane in enumerate(planes)])
+
+def fitch_join(sets_a, sets_b):
+    # Fitch state sets of the parent of two nodes, and the mask of the
+    # sites where a change is needed (those with disjoint sets)
+    shared = [a & b for a, b in zip(sets_a, sets_b)]
+    common = 0
+    sites = 0
+    for mask, a, b in zip(shared, sets_a, sets_b):
+        common |= mask
+        sites |= a | b
+    changes = sites & ~common
+
+    return ([s | (a | b) & changes for s, a, b in
+        zip(shared, sets_a, sets_b)], changes)
+
+def leaf_sets(matrix):
+    # state sets of all taxa, as a list of per-state bit masks; gaps and
+    # missing data are read as any state
+    n_states = max(charmatrix.n_codes(matrix), 1)
+    ret = {}
+    for taxon in matrix['taxa']:
+        row = matrix['rows'][taxon]
+        unknown = (charmatrix.code_mask(row, charmatrix.GAP) |
+            charmatrix.code_mask(row, charmatrix.MISSING))
+        ret[taxon] = [charmatrix.code_mask(row, code) | unknown
+            for code in range(n_states)]
+
+    return ret
+
+def fitch(tree, matrix, weights=None):
+    # compute the (weighted) parsimony length of `tree` for `matrix`,
+    # returning the length and the downpass (preliminary) state sets of the
+    # root; `weights` default to those of a compressed matrix, if any
+    if weights is None:
+        weights = matrix.get('weights')
+    planes = weight_planes(weights) if weights else None
+
+    n_chars = len(matrix['chars'])
+    all_sites = (1 << n_chars) - 1
+    leaves = leaf_sets(matrix)
+    n_states = len(next(iter(leaves.values()), []))
+
+    length = 0
+    sets = {}
+    for node in newick.postorder(tree):
+        if not node['children']:
+            sets[id(node)] = leaves[node['name']]
+            continue
+
+        # `count[s][c]` has the sites where state `s` is in the sets of at
+        # least `c` children
+        n_children = len(node['children'])
+        count = [[all_sites] + [0] * n_children for _ in range(n_states)]
+        for child in node['children']:
+            child_sets = sets.pop(id(child))
+            for state in range(n_states):
+                state_count = count[state]
+                for c in range(n_children, 0, -1):
+                    state_count[c] |= state_count[c-1] & child_sets[state]
+
+        # the set of each site has the states found in most children, with
+        # a cost of one change for each child not including them
+        node_sets = [0] * n_states
+        remaining = all_sites
+        for c in range(n_children, 0, -1):
+            found = 0
+            for state in range(n_states):
+                found |= count[state][c]
+            found &= remaining
+            if not found:
+                continue
+
+            for state in range(n_states):
+                node_sets[state] |= count[state][c] & found
+            length += (n_children - c) * weighted_count(found, planes)
+            remaining &= ~found
+
+        sets[id(node)] = node_sets
+
+    return length, sets[id(tree)]
+
+def _sankoff_column(nodes, column, states):
+    # MPR state sets of all `nodes` (in postorder, as (node, leaf_index)
+    # tuples) for a single site pattern, considering only the observed
+    # `states`, as no other state can be part of a MPR with unit costs
+    inf = float('inf')
+    down = {}
+    for node, leaf_idx in nodes:
+        if leaf_idx is not None:
+            code = column[leaf_idx]
+            if code in states:
+                down[id(node)] = [0 if s == code else inf for s in states]
+            else:
+                down[id(node)] = [0] * len(states)
+        else:
+            costs = [0] * len(states)
+            for child in node['children']:
+                child_down = down[id(child)]
+                best = min(child_down) + 1
+                costs = [cost + min(d, best)
+                    for cost, d in zip(costs, child_down)]
+            down[id(node)] = costs
+
+    # uppass, from the root, combining the costs of the rest of the tree
+    up = {id(nodes[-1][0]) : [0] * len(states)}
+    ret = {}
+    for node, leaf_idx in reversed(nodes):
+        node_up = up[id(node)]
+        node_down = down[id(node)]
+        total = [u + d for u, d in zip(node_up, node_down)]
+        best = min(total)
+        ret[id(node)] = tuple([s for s, t in zip(states, total) if t == best])
+
+        for child in node['children']:
+            child_down = down[id(child)]
+            child_best = min(child_down) + 1
+            rest = [t - min(d, child_best)
+                for t, d in zip(total, child_down)]
+            rest_best = min(rest) + 1
+            up[id(child)] = [min(r, rest_best) for r in rest]
+
+    return ret
+
+def ancestral_states(tree, matrix):
+    # MPR state sets (tuples of codes) for every node of `tree`, returning
+    # the list of node names (in postorder) and, for each character of
+    # `matrix`, the list of the sets of each node; the computation is
+    # performed once for each unique site pattern
+    taxa = matrix['taxa']
+    patterns = charmatrix.compress_patterns(matrix)
+    leaf_index = dict((taxon, idx) for idx, taxon in enumerate(taxa))
+    nodes = [(node, None if node['children'] else leaf_index[node['name']])
+        for node in newick.postorder(tree)]
+
+    columns = zip(*[patterns['rows'][taxon] for taxon in taxa])
+    states = [None] * len(matrix['chars'])
+    for column, index in zip(columns, patterns['index']):
+        observed = sorted(set(column) - set([charmatrix.GAP,
+            charmatrix.MISSING]))
+        if observed:
+            node_sets = _sankoff_column(nodes, column, observed)
+        else:
+            node_sets = dict((id(node), (charmatrix.MISSING,))
+                for node, _ in nodes)
+
+        # leaves keep their observed states, with gaps and missing data
+        # being reconstructed as for internal nodes
+        column_sets = []
+        for node, leaf_idx in nodes:
+            if leaf_idx is not None and column[leaf_idx] in observed:
+                column_sets.append((column[leaf_idx],))
+            else:
+                column_sets.append(node_sets[id(node)])
+
+        for c_idx in index:
+            states[c_idx] = column_sets
+
+    return node_names(tree), states
+
+def asr_table(tree, matrix):
+    # the reconstruction as a table of strings, as reported by Mesquite's
+    # "Trace All Characters": the node names (with blanks instead of
+    # underscores) and, for each character, the states of each node,
+    # separated by spaces when more than one
+    names, states = ancestral_states(tree, matrix)
+    names = [name.replace('_', ' ') for name in names]
+
+    symbols = {}
+    table = []
+    for char_states in states:
+        cells = []
+        for node_states in char_states:
+            if node_states not in symbols:
+                symbols[node_states] = ' '.join([
+                    chr(charmatrix.CODE2SYMBOL[code]) if code in
+                    (charmatrix.GAP, charmatrix.MISSING) else str(code)
+                    for code in node_states])
+            cells.append(symbols[node_states])
+        table.append(cells)
+
+    return names, table
+
+def output_asr(tree, matrix, out_file):
+    # write the reconstruction in the tab-separated format of Mesquite's
+    # "Trace All Characters", so that it can be read by
+    # `test_asr.read_asr_data()`
+    names, table = asr_table(tree, matrix)
+
+    with open(out_file, 'w') as handler:
+        handler.write('Trace All Characters\n\n')
+        handler.write('Ancestral states are listed by character and by node ')
+        handler.write('on the tree.\n\n')
+        handler.write('Char.\\Node\t%s\n' % '\t'.join(names))
+
+        for c_idx, cells in enumerate(table):
+            handler.write('character %i\t%s\n' % (c_idx+1, '\t'.join(cells)))
+
+def main():
+    # parsimony length of the trees embedded in the reduced matrix
+    matrix = nexusio.read_matrix('data/tresoldi_red.nex')
+    patterns = charmatrix.compress_patterns(matrix)
+    for name, tree in nexusio.read_trees('data/tresoldi_red.nex'):
+        length, _ = fitch(tree, patterns)
+        print(name, 'length', length)
+
+if __name__ == '__main__':
+    main()
@@ -26,8 +26,13 @@
 # the various loci ("words") are stored as taxa, when the manuscripts
 # are stored as characters (it should be the opposite)
 
+import functools
 import logging
-#from nexus import NexusReader
+import operator
+import os
+
+import charmatrix
+import nexusio
 
 # TODO: check 'Absent' for gap
 # TODO: check when form starts with an empty string ' a b', which is
@@ -39,12 +44,6 @@ CANTICA = {'IN' : 'I',
            'PA' : 'Z'
           }
 
-def clean_line(line):
-    line = line.replace('\t', '')
-    line = line.replace('\n', '')
-
-    return line
-
 # fix labels used by Shaw and Robinson so they can be sorted easily
 def fix_label(label):
     fields = label.split('_')
@@ -56,90 +55,91 @@ def fix_label(label):
     return '{}_{:02d}_{:03d}_{:03d}'.format(cantica, canto, verso, parola)
 
 def read_shaw_nexus(filename):
+    # parsed files are cached (as long as they are not modified), so that
+    # reading a file again does not parse it twice; the returned `matrix`
+    # dictionary is a copy that can be changed by the caller, but `states`
+    # is shared
+    stat = os.stat(filename)
+    data = _read_shaw_nexus(filename, stat.st_size, stat.st_mtime_ns)
+
+    return {
+        'states' : data['states'],
+        'matrix' : dict(data['matrix']),
+        'single_states' : list(data['single_states']),
+    }
+
+@functools.lru_cache(maxsize=8)
+def _read_shaw_nexus(filename, size, mtime):
     # reading line by line, as files are rather large and python nexus
     # libraries (such as Simon Greenhill's one) are failing (maybe the
     # format of the data is not adequate)
-    logging.info("Parsing %s...", filename)
-
-    # where we are in the file
-    part = None
-
     # data from the nexus file
     states = {}
     taxa = []
     matrix = {}
     single_states = []
 
-    # method for reading the different parts of the nexus file
-    with open(filename) as nexus:
-        for line in nexus:
-            # check if we are in a new part
-            if 'STATELABELS' in line:
-                # around line 20
-                part = 'STATELABELS'
-            elif 'TAXLABELS' in line:
-                # around line 90000
-                part = 'TAXLABELS'
-            elif 'MATRIX' in line:
-                # around line 90000; this is stored after the TAXLABELS,
-                # so that we can initialize the matrix of witnesses
-                # appropriately
-                part = 'MATRIX'
-
-                for taxon in taxa:
-                    matrix[taxon] = ''
-            elif 'endblock' in line:
-                # at the bottom of the file, mostly
-                part = None
-
-            # parse according to `part`
-            if part == 'STATELABELS':
-                # clean line and split
-                line = clean_line(line)
-                fields = line.split(' ', 2)
-
-                # skip noisy lines
-                if len(fields) == 3:
-                    # we are only storing label and form, as the index
-                    # will be kept from the position in the list
-                    index, label, form = fields
-                    label = fix_label(label)
-
-                    states[label] = { 'form' : form }
-
-            elif part == 'TAXLABELS':
-                # clean line and split
-                line = clean_line(line)
-                fields = line.split(' ', 2)
-
-                # skip noisy lines
-                if len(fields) == 2:
-                    # we are only storing the name of the taxa, as the
-                    # index will be kept from the position in the list
-                    index, taxon_name = fields
-
-                    taxa.append(taxon_name)
-
-            elif part == 'MATRIX':
-                # clean line and split
-                line = clean_line(line)
-                fields = line.split(' ', 3)
-
-                # skip noisy lines
-                if len(fields) == 3:
-                    index, label, data = fields
-                    label = fix_label(label)
-
-                    # store the properties
-                    for i, char in enumerate(data):
-                        taxon = taxa[i]
-                        matrix[taxon] += char
-
-                    # check single states  and collect a list of them
-                    n_states = len(set(data))
-                    states[label]['n_states'] = n_states
-                    if n_states == 1:
-                        single_states.append(label)
+    # the loci are stored as taxa, so that each line of the matrix is a
+    # column of the witnesses' rows; they are collected and transposed in
+    # bulk at the end
+    columns = []
+
+    # the different parts of the nexus file are streamed by `nexusio`
+    for block, part, line in nexusio.iter_nexus(filename):
+        # parse according to `part`
+        if part in ['STATELABELS', 'CHARSTATELABELS']:
+            fields = line.split(' ', 2)
+
+            # skip noisy lines
+            if len(fields) == 3:
+                # we are only storing label and form, as the index
+                # will be kept from the position in the list
+                index, label, form = fields
+                label = fix_label(label)
+
+                states[label] = { 'form' : form }
+
+        elif part == 'TAXLABELS':
+            fields = line.split(' ', 2)
+
+            # skip noisy lines
+            if len(fields) == 2:
+                # we are only storing the name of the taxa, as the
+                # index will be kept from the position in the list
+                index, taxon_name = fields
+
+                taxa.append(taxon_name)
+
+        elif part == 'MATRIX':
+            fields = line.split(' ', 3)
+
+            # skip noisy lines
+            if len(fields) == 3:
+                index, label, data = fields
+                label = fix_label(label)
+
+                # store the properties
+                columns.append(data)
+
+                # check single states  and collect a list of them
+                n_states = len(set(data))
+                states[label]['n_states'] = n_states
+                if n_states == 1:
+                    single_states.append(label)
+
+    # transpose: when all columns have one state per taxon, the row of the
+    # i-th taxon is every len(taxa)-th character of their concatenation
+    if all([len(column) == len(taxa) for column in columns]):
+        buf = ''.join(columns)
+        for i, taxon in enumerate(taxa):
+            matrix[taxon] = buf[i::len(taxa)]
+    else:
+        rows = [[] for taxon in taxa]
+        for column in columns:
+            for i, char in enumerate(column):
+                rows[i].append(char)
+        for taxon, row in zip(taxa, rows):
+            matrix[taxon] = ''.join(row)
 
     # return value
     ret = {
@@ -166,11 +166,8 @@ def compare_matrices(m2r1l0, m2r1l2, m0r1l0):
             if m2r1l2['matrix'][wit] != m0r1l0['matrix'][wit]:
                 logging.warning('%s is different in m2r1l2 and m0r1l0', wit)
 
-def extract_matrix(data, state_names):
-    # compare all witnesses; the `reference` is just a random
-    # manuscript used for the comparison and identification of single states
+def extract_matrix(data, state_names, compress=False, drop_invariant=False):
     witnesses = list(data.keys())
-    reference = witnesses[0]
 
     # initialize witnesses' and state matrices
     ret = {
@@ -179,47 +176,65 @@ def extract_matrix(data, state_names):
         'max_states' : 0,
     }
 
-    for char_idx in range(len(data[reference])):
-        # compare all witnesses with the first one in the list, as we will
-        # only have a single state if all are equal; we are actually
-        # comparing the reference with itself, it makes the code simpler
-        ref_state = data[reference][char_idx]
-        single_state = True
-        for witness in witnesses:
-            if data[witness][char_idx] != ref_state:
-                logging.debug('different state in %s (#%i - %s)',
-                    witness, char_idx, state_names[char_idx])
-                single_state = False
-                break
+    # indexes of the non single state chars in `state_names`
+    kept = []
 
-        # only append non single state chars
-        if not single_state:
-            ret['states'].append(state_names[char_idx])
-
-            states = set()
-            for witness in witnesses:
-                state = data[witness][char_idx]
-
-                ret['taxa'][witness] += state
+    # compare all witnesses column by column, as we will only have a single
+    # state if all are equal
+    rows = [data[witness] for witness in witnesses]
+    for char_idx, column in enumerate(zip(*rows)):
+        if column.count(column[0]) == len(column):
+            continue
 
-                if state not in ['?', '-']:
-                    states.add(state)
+        logging.debug('different states in #%i - %s',
+            char_idx, state_names[char_idx])
 
-            # count the number of states, excluding gaps and missing, for
-            # keeping track of global maximum
-            num_states = len(states)
-            if num_states > ret['max_states']:
-                ret['max_states'] = num_states
+        # only append non single state chars
+        ret['states'].append(state_names[char_idx])
+        kept.append(char_idx)
+
+        # count the number of states, excluding gaps and missing, for
+        # keeping track of global maximum
+        num_states = len(set(column) - set(['?', '-']))
+        if num_states > ret['max_states']:
+            ret['max_states'] = num_states
+
+    # extract the kept chars of each witness in bulk
+    if kept:
+        getter = operator.itemgetter(*kept)
+        for witness, row in zip(witnesses, rows):
+            ret['taxa'][witness] = ''.join(getter(row))
+
+    # collapse identical columns into weighted site patterns, keeping the
+    # name of the first locus of each one, an `index` of the original loci
+    # (as indexes into `state_names`), and their names (`loci`)
+    if compress:
+        patterns = charmatrix.compress_columns(
+            [ret['taxa'][witness] for witness in witnesses], '?-',
+            drop_invariant)
+
+        rows = list(zip(*patterns['columns'])) or [()] * len(witnesses)
+        ret['taxa'] = dict((witness, ''.join(row))
+            for witness, row in zip(witnesses, rows))
+        ret['index'] = [[kept[i] for i in index]
+            for index in patterns['index']]
+        ret['loci'] = [[state_names[i] for i in index]
+            for index in ret['index']]
+        ret['states'] = [labels[0] for labels in ret['loci']]
+        ret['weights'] = patterns['weights']
+        ret['invariant'] = patterns['invariant']
 
     return ret
 
-def output_nexus(data):
+def output_nexus(data, out_file='data/shaw.nex'):
+    # write the matrix with `nexusio.open_output()`, so that `out_file` can
+    # also be compressed ('.gz', '.zst') and is replaced only when complete
     taxa = sorted(list(data['taxa']))
     taxlabels = ' '.join(taxa)
     nchar = len(data['taxa']['Ash'])
     symbols = ' '.join([str(v) for v in range(data['max_states'])])
 
-    with open('data/shaw.nex', 'w') as nexus:
+    with nexusio.open_output(out_file) as nexus:
         nexus.write('#NEXUS\n\n')
 
         nexus.write('BEGIN TAXA;\n')
@@ -245,6 +260,20 @@ def output_nexus(data):
 
         nexus.write('END;\n\n')
 
+        # weights of compressed site patterns
+        if 'weights' in data:
+            wtsets = charmatrix.weights_sets(data['weights'])
+            buf = ['%i: %s' % (weight, ' '.join([str(c) for c in chars]))
+                for weight, chars in sorted(wtsets.items())]
+
+            nexus.write('BEGIN ASSUMPTIONS;\n')
+            nexus.write('\t[%i invariant sites]\n' % data['invariant'])
+            nexus.write('\tWTSET * patterns = %s;\n' % ', '.join(buf))
+            nexus.write('\t[original loci of each pattern]\n')
+            for comment in charmatrix.loci_comments(data['loci']):
+                nexus.write('\t%s\n' % comment)
+            nexus.write('END;\n\n')
+
 def main():
     # read data and rename keys (witnesses) accordingly
     m2r1l0 = read_shaw_nexus('data/M2R1L0.nex')
@@ -257,7 +286,7 @@ def main():
     m2r1l2['matrix']['R1'] = m2r1l2['matrix'].pop('Rb')
     m2r1l2['matrix']['L2'] = m2r1l2['matrix'].pop('LauSC')
 
-    m0r1l0 = read_shaw_nexus('data/M2R1L0.nex')
+    m0r1l0 = read_shaw_nexus('data/M0R1L0.nex')
     m0r1l0['matrix']['Ald'] = m0r1l0['matrix'].pop('Mart')
     m0r1l0['matrix']['R1']  = m0r1l0['matrix'].pop('Rb')
     m0r1l0['matrix']['L0']  = m0r1l0['matrix'].pop('LauSC')
@@ -3,116 +3,350 @@
 
 # read data from Mesquite's ASR and compare to a gold standard
 
+import array
+import collections
+import contextlib
+import hashlib
+import logging
+import mmap
+import os
+import struct
+
+import charmatrix
+import nexusio
+import parsimony
 import transcription2nexus as t2n
 
 WITNESSES = ['Rb', 'Urb', 'Ash', 'Ham', 'Triv', 'Mart', 'Mart c2', 'LauSC']
 
-def read_asr_data(filename):
-    ancestor_states = []
-    info_states = 0 # number of informtive states
-
-    with open(filename) as handler:
-        in_matrix = False
-        for line in handler:
-            line = line.rstrip()
-
-            if line.startswith('Char.'):
-                witnesses_str = line[len('Char.\\Node\t'):]
-                witnesses = witnesses_str.split('\t')
-                in_matrix = True
-                continue
-
-            if in_matrix:
-                if line == '':
-                    continue
-                fields = line.split('\t')
-                char, states = fields[0], fields[1:]
-
-                # character number
-                char_idx = int(char.split(' ')[1])
-
-                # whether all elements in 'states' are equal (i.e., if the
-                # character is informative)
-                char_info = all(x==states[0] for x in states)
-                if char_info is False:
-                    info_states += 1
-
-                # the last state is the ancestor
-                ancestor = states[-1]
-
-                # list of witnesses with the states equal to the ancestor
-                # (most times, only one state)
-                char_ancestor_states = []
-
-                for state in ancestor.split(' '):
-                    # look for a witness with the same state, provided it is
-                    # not a reconstructed state (i.e., it is a witness)
-                    same_state = None
-                    for W in WITNESSES:
-                        w_idx = witnesses.index(W)
-                        if states[w_idx] == state:
-                            char_ancestor_states.append(W.replace(' ', '_'))
-                            break
-
-                # returned list
-                ancestor_states.append([char_info, char_ancestor_states])
-
-                #print(char, [char_idx], states, char_ancestor_states)
+def witness_indices(witnesses):
+    # (label, column) of each of our WITNESSES in a table of node names,
+    # computed once per table
+    return [(W.replace(' ', '_'), witnesses.index(W)) for W in WITNESSES]
+
+def asr_char_data(w_indices, states):
+    # whether all elements in 'states' are equal (i.e., if the
+    # character is informative)
+    char_info = all(x==states[0] for x in states)
+
+    # the last state is the ancestor
+    ancestor = states[-1]
+
+    # list of witnesses with the states equal to the ancestor
+    # (most times, only one state)
+    char_ancestor_states = []
+
+    for state in ancestor.split(' '):
+        # look for a witness with the same state, provided it is
+        # not a reconstructed state (i.e., it is a witness)
+        for W, w_idx in w_indices:
+            if states[w_idx] == state:
+                char_ancestor_states.append(W)
+                break
+
+    return [char_info, char_ancestor_states]
+
+# header of the binary caches of ASR dumps, followed by the size and
+# modification time of the dump, by the number of characters, and by the
+# digest of WITNESSES and of the header line of the dump, as ancestors are
+# stored as indexes into WITNESSES
+ASR_CACHE_MAGIC = b'ASRCACHE2'
+ASR_CACHE_HEADER = struct.Struct('<9sQqQ20s')
+
+def asr_signature(header):
+    # digest of our WITNESSES and of the header line of a dump
+    sha = hashlib.sha1('\t'.join(WITNESSES).encode('utf-8'))
+    sha.update(b'\n' + header.encode('utf-8'))
+
+    return sha.digest()
+
+@contextlib.contextmanager
+def asr_index(filename, cache=True):
+    # `index_asr()` as a context manager, closing the memory map at the end
+    index = index_asr(filename, cache)
+    try:
+        yield index
+    finally:
+        index['mmap'].close()
+
+def index_asr(filename, cache=True):
+    # index a Mesquite "Trace All Characters" dump, memory-mapping it and
+    # collecting, for each character, the offset of its line, whether all
+    # its node states are equal, and its ancestor witnesses (as indexes
+    # into our WITNESSES); the index is stored in a binary cache next to the
+    # dump (`filename` + '.asrcache'), which is used while the size and the
+    # modification time of the dump, WITNESSES and the node names are
+    # unchanged; the memory map (`index['mmap']`) must be closed by the
+    # caller, see `asr_index()`
+    with open(filename, 'rb') as handler:
+        mm = mmap.mmap(handler.fileno(), 0, access=mmap.ACCESS_READ)
+
+    stat = os.stat(filename)
+    index = {
+        'filename' : filename,
+        'mmap' : mm,
+        'witnesses' : None,
+        'offsets' : array.array('Q'),
+        'equal' : bytearray(),
+        'ancestor_starts' : array.array('I', [0]),
+        'ancestors' : bytearray(),
+    }
+
+    # the header line with the node names is always parsed
+    header = mm.find(b'Char.')
+    header_end = mm.find(b'\n', header)
+    if header_end < 0:
+        header_end = len(mm)
+    line = mm[header:header_end].decode('utf-8').rstrip()
+    index['witnesses'] = line[len('Char.\\Node\t'):].split('\t')
+    signature = asr_signature(line)
+
+    cache_file = filename + '.asrcache'
+    if cache and _read_asr_cache(index, cache_file, stat, signature):
+        return index
+
+    # label -> index of our witnesses
+    names = [W.replace(' ', '_') for W in WITNESSES]
+    w_indices = witness_indices(index['witnesses'])
+
+    mm.seek(header_end + 1)
+    while True:
+        offset = mm.tell()
+        line = mm.readline()
+        if not line:
+            break
+
+        line = line.decode('utf-8').rstrip()
+        if line == '':
+            continue
+        states = line.split('\t')[1:]
+
+        char_info, char_ancestor_states = asr_char_data(w_indices, states)
+        index['offsets'].append(offset)
+        index['equal'].append(char_info)
+        index['ancestors'].extend(
+            [names.index(w) for w in char_ancestor_states])
+        index['ancestor_starts'].append(len(index['ancestors']))
+
+    if cache:
+        _write_asr_cache(index, cache_file, stat, signature)
+
+    return index
+
+def _read_asr_cache(index, cache_file, stat, signature):
+    # the cached arrays are read into new objects, and only stored in
+    # `index` if the cache is complete, as a truncated cache would
+    # otherwise be accepted (or leave partial data to the parser)
+    try:
+        with open(cache_file, 'rb') as handler:
+            magic, size, mtime, n_chars, cached = ASR_CACHE_HEADER.unpack(
+                handler.read(ASR_CACHE_HEADER.size))
+            if (magic, size, mtime, cached) != (ASR_CACHE_MAGIC,
+                    stat.st_size, stat.st_mtime_ns, signature):
+                return False
+
+            offsets = array.array('Q')
+            offsets.fromfile(handler, n_chars)
+            equal = bytearray(handler.read(n_chars))
+            ancestor_starts = array.array('I')
+            ancestor_starts.fromfile(handler, n_chars+1)
+            ancestors = bytearray(handler.read(ancestor_starts[-1]))
+            trailing = handler.read(1)
+    except (OSError, EOFError, ValueError, struct.error):
+        return False
+
+    if len(equal) != n_chars or len(ancestors) != ancestor_starts[-1] \
+        or trailing:
+        return False
+
+    index['offsets'] = offsets
+    index['equal'] = equal
+    index['ancestor_starts'] = ancestor_starts
+    index['ancestors'] = ancestors
+
+    return True
+
+def _write_asr_cache(index, cache_file, stat, signature):
+    # written to a temporary file first, so that an interrupted write does
+    # not leave a truncated cache
+    tmp_file = '%s.%i.tmp' % (cache_file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as handler:
+            handler.write(ASR_CACHE_HEADER.pack(ASR_CACHE_MAGIC, stat.st_size,
+                stat.st_mtime_ns, len(index['offsets']), signature))
+            index['offsets'].tofile(handler)
+            handler.write(index['equal'])
+            index['ancestor_starts'].tofile(handler)
+            handler.write(index['ancestors'])
+        os.replace(tmp_file, cache_file)
+    except OSError as error:
+        logging.warning('cannot write ASR cache %s: %s', cache_file, error)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def asr_char_states(index, char_idx):
+    # node states of a character (zero-based), read from the dump
+    mm = index['mmap']
+    offset = index['offsets'][char_idx]
+    end = mm.find(b'\n', offset)
+    if end < 0:
+        end = len(mm)
+
+    return mm[offset:end].decode('utf-8').rstrip().split('\t')[1:]
+
+def asr_ancestors(index, char_idx):
+    # ancestor witnesses of a character (zero-based)
+    start, end = index['ancestor_starts'][char_idx:char_idx+2]
+    return [WITNESSES[w].replace(' ', '_')
+        for w in index['ancestors'][start:end]]
+
+def iter_informative(index):
+    # yield (character index, ancestor witnesses) for the characters whose
+    # node states are not all equal
+    for char_idx, char_info in enumerate(index['equal']):
+        if not char_info:
+            yield char_idx, asr_ancestors(index, char_idx)
+
+def read_asr_data(filename, cache=True):
+    with asr_index(filename, cache) as index:
+        ancestor_states = [[bool(char_info), asr_ancestors(index, char_idx)]
+            for char_idx, char_info in enumerate(index['equal'])]
+        info_states = index['equal'].count(0) # number of informtive states
 
     return ancestor_states, info_states
 
-def test_similarity(asr, nexus, info_states):
-    chars = sorted(nexus['chars'])
-
-    # states with right and wrong countings, with one or more than one
-    # alterntive
-    right_single, right_multi = 0, 0
-    wrong_single, wrong_multi = 0, 0
-
-    for i, char in enumerate(chars):
-        # check all witnesses
-        pet_in_wit = []
-
-        for w in asr[i][1]:
-            # collect all manuscripts with a reported lesson, adding '-c2', '-c1',
-            # and '-orig', in this order, to it if available when the manuscript 
-            # reading is not reported
-            all_w = [v for v in nexus['chars'][char].values()]
-            all_w = [w for sublist in all_w for w in sublist]
-            if w not in all_w:
-                if w+'-c2' in all_w:
+def native_asr_data(nexus_file, tree_name):
+    # same as `read_asr_data()`, but reconstructing the ancestral states
+    # with `parsimony` for a tree in the NEXUS file, instead of reading
+    # them from a Mesquite dump
+    matrix = nexusio.read_matrix(nexus_file)
+    tree = dict(nexusio.read_trees(nexus_file))[tree_name]
+
+    return tree_asr_data(tree, matrix)
+
+def tree_asr_data(tree, matrix):
+    # same as `native_asr_data()`, for a tree (as parsed by `newick`) and a
+    # matrix already in memory; the states are reconstructed once for each
+    # unique site pattern, and expanded to all characters
+    patterns = charmatrix.compress_patterns(matrix)
+    witnesses, table = parsimony.asr_table(tree, patterns)
+    w_indices = witness_indices(witnesses)
+
+    ancestor_states = [None] * len(matrix['chars'])
+    for states, index in zip(table, patterns['index']):
+        char_data = asr_char_data(w_indices, states)
+        for c_idx in index:
+            ancestor_states[c_idx] = char_data
+    info_states = len([c for c in ancestor_states if c[0] is False])
+
+    return ancestor_states, info_states
+
+def score_tables(nexus, names=None):
+    # precompute, for each character of the `nexus` collation and each
+    # witness name that can be reported as an ancestor (by default, our
+    # WITNESSES), how many entries a witness adds to the comparison with
+    # the reference and whether any of them agrees with PETrocchi; each
+    # character is stored as the index of its signature (the tuple of
+    # counts and the bit mask of agreeing witnesses), as most characters
+    # share very few of them
+    if names is None:
+        names = [W.replace(' ', '_') for W in WITNESSES]
+
+    tables = {
+        'names' : list(names),
+        'bits' : dict((name, 1 << idx) for idx, name in enumerate(names)),
+        'signatures' : [],
+        'chars' : array.array('I'),
+    }
+
+    signature_idx = {}
+    for char in sorted(nexus['chars']):
+        states = nexus['chars'][char]
+
+        # witness -> labels of the states it is reported in, once per state
+        w_labels = {}
+        for label, witnesses in states.items():
+            for w in witnesses:
+                labels = w_labels.setdefault(w, [])
+                if not labels or labels[-1] != label:
+                    labels.append(label)
+
+        counts = []
+        hits = 0
+        for idx, name in enumerate(names):
+            # use the '-c2', '-c1', and '-orig' layers, in this order, when
+            # the manuscript reading is not reported
+            w = name
+            if w not in w_labels:
+                if w+'-c2' in w_labels:
                     w += '-c2'
-                elif w+'-c1' in all_w:
-                   w += '-c1'
+                elif w+'-c1' in w_labels:
+                    w += '-c1'
                 else:
                     w += '-orig'
 
-            # if the label is '{{?}}', there is an omission in the manuscript and
-            # the ancestral state was reconstructed accondingly
-            if '{{?}}' in nexus['chars'][char]:
-                if w in nexus['chars'][char]['{{?}}']:
-                    pet_in_wit.append(True)
-
-            # identify if state label with witness also includes the reference
-            for label in nexus['chars'][char]:
-                if w in nexus['chars'][char][label]:
-                    if 'PET' in nexus['chars'][char][label]:
-                        pet_in_wit.append(True)
-                    else:
-                        pet_in_wit.append(False)
-
-
-        if True in pet_in_wit:
-            # count right reconstructions with one or more than one option
-            if len(pet_in_wit) == 1:
-                right_single += 1
-            else:
-                right_multi += 1
-        else:
-            if len(pet_in_wit) == 1:
-                wrong_single += 1
-            else:
-                wrong_multi += 1
+            # an omission ('{{?}}') counts as an agreement, besides being
+            # compared as any other label
+            labels = w_labels.get(w, [])
+            count = len(labels)
+            hit = False
+            if '{{?}}' in labels:
+                count += 1
+                hit = True
+            if [l for l in labels if 'PET' in states[l]]:
+                hit = True
+
+            counts.append(count)
+            if hit:
+                hits |= 1 << idx
+
+        signature = (tuple(counts), hits)
+        if signature not in signature_idx:
+            signature_idx[signature] = len(tables['signatures'])
+            tables['signatures'].append(signature)
+        tables['chars'].append(signature_idx[signature])
+
+    return tables
+
+def asr_masks(tables, asr):
+    # the ancestor witnesses of each character, as bit masks
+    bits = tables['bits']
+    return array.array('I', [sum([bits.get(w, 0) for w in set(char[1])])
+        for char in asr])
+
+def score_batch(tables, asrs):
+    # score many ASR outputs (lists as returned by `read_asr_data()`)
+    # against the same collation; the outcome of each combination of
+    # character signature and ancestor witnesses is computed only once
+    outcomes = {}
+    ret = []
+    for asr in asrs:
+        combinations = collections.Counter(
+            zip(tables['chars'], asr_masks(tables, asr)))
+
+        scores = {
+            'right_single' : 0, 'right_multi' : 0,
+            'wrong_single' : 0, 'wrong_multi' : 0,
+        }
+        for key, num in combinations.items():
+            if key not in outcomes:
+                (counts, hits), mask = tables['signatures'][key[0]], key[1]
+                entries = sum([count for idx, count in enumerate(counts)
+                    if mask >> idx & 1])
+                outcome = 'right' if hits & mask else 'wrong'
+                outcome += '_single' if entries == 1 else '_multi'
+                outcomes[key] = outcome
+
+            scores[outcomes[key]] += num
+
+        ret.append(scores)
+
+    return ret
+
+def test_similarity(asr, nexus, info_states):
+    scores = score_batch(score_tables(nexus), [asr])[0]
+    right_single, right_multi = scores['right_single'], scores['right_multi']
+    wrong_single, wrong_multi = scores['wrong_single'], scores['wrong_multi']
 
     # report results
     print('informative states / all states', info_states, len(asr))
@@ -126,22 +360,13 @@ if __name__ == '__main__':
     ASR_FILE = 'data/asr_tree_tresoldi.txt'
 #    ASR_FILE = 'data/asr_tree_mlconsensus.txt'
 
-    # read ASR data
+    # read ASR data, either from Mesquite or reconstructing it natively
     ancestor_states, info_states = read_asr_data(ASR_FILE)
+#    ancestor_states, info_states = native_asr_data(
+#        'data/tresoldi_red.nex', 'Tresoldi')
 
-    # rebuild NEXUS data
-    # set descripti, read new data and output reduced
-    descripti = [
-        'Urb-orig', 'Urb-c1', 'Urb-c2',
-        'Rb-orig', 'Rb-c1', 'Rb-c2',
-        'Ash-orig', 'Ash-c1', 'Ash-c2',
-        'Ham-orig', 'Ham-c1', 'Ham-c2',
-        'Mart-orig', 'Mart-c1', 'Mart-c2-1',
-        'LauSC-orig', 'LauSC-c1', 'LauSC-c2', 'LauSC-c3', 'LauSC-c4',
-        'Triv-orig', 'Triv-c1', 'Triv-c2',
-        'PET', 'FS', 'LEO',]
-
-    nexus = t2n.read_data(None, 'data/transcription', False, descripti)
+    # rebuild NEXUS data, without the descripti
+    nexus = t2n.read_data(None, 'data/transcription', False, t2n.DESCRIPTI)
 
     # finally test
     test_similarity(ancestor_states, nexus, info_states)
@@ -0,0 +1,28 @@
+import newick
+import nexusio
+
+TREES = """#NEXUS
+BEGIN TREES;
+    TRANSLATE
+        1 Ash,
+        2 'Mart c2',
+        3 Rb
+    ;
+    tree STATE_0 = ((1[&rate=1.0]:0.1,2:0.2):0.3,3:0.4);
+END;
+BEGIN TREES;
+    tree plain = ((1,Ham),Rb);
+END;
+"""
+
+def test_read_trees_translate(tmp_path):
+    # leaves are renamed after the TRANSLATE command of their block only
+    filename = tmp_path / 'trees.nex'
+    filename.write_text(TREES)
+
+    trees = nexusio.read_trees(str(filename))
+
+    assert [name for name, _ in trees] == ['STATE_0', 'plain']
+    assert newick.leaf_names(trees[0][1]) == ['Ash', 'Mart c2', 'Rb']
+    assert newick.leaf_names(trees[1][1]) == ['1', 'Ham', 'Rb']
+    assert list(nexusio.iter_trees(str(filename)))[0][1].startswith('((1')
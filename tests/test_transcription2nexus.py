@@ -0,0 +1,27 @@
+import json
+
+import transcription2nexus as t2n
+
+def write_verses(path, verses):
+    path.mkdir()
+    for name, loci in verses.items():
+        with open(path / name, 'w') as handler:
+            json.dump(loci, handler)
+
+def test_cached_verses_with_same_contents(tmp_path):
+    # verses with the same contents must not share a cache entry, as the
+    # labels of their loci come from the file names
+    loci = [{'lo' : ['Ash', 'Urb'], 'la' : ['Rb']}]
+    write_verses(tmp_path / 'tr', {
+        'IN_01_001.json' : loci,
+        'IN_01_002.json' : loci,
+        'IN_01_003.json' : [{'e' : ['Ash', 'Urb', 'Rb']}],
+    })
+    cache_dir = str(tmp_path / 'cache')
+
+    runs = [t2n.read_data(None, str(tmp_path / 'tr'), False, [], 1, cache_dir)
+        for _ in range(2)]
+
+    expected = ['I_01_001_0', 'I_01_002_0', 'I_01_003_0']
+    assert [sorted(run['chars']) for run in runs] == [expected, expected]
+    assert runs[0]['chars'] == runs[1]['chars']
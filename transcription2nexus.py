@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
-import copy
+import collections
+import functools
 import glob
+import hashlib
 import logging
 import json
+import multiprocessing
 import os.path
+import pickle
+import re
+
+import charmatrix
+import instrument
+import nexusio
+import treebuild
 
 # map for the 'canto' variable, to make sure the order is kept with sort()
 CANTICA = {'IN' : 'I',
@@ -47,7 +57,170 @@ LEONARDI = {
     'Z_31_020_2' : 'plenitudine',
 }
 
-def read_data(maxfiles, in_path, include_leo=True, descripti=[]):
+# witnesses removed from the reduced matrices (layers of the manuscripts,
+# editions, and LEOnardi); `descriptus.check_descripti()` compares this list
+# with the descripti found in the full matrix
+DESCRIPTI = [
+    'Urb-orig', 'Urb-c1', 'Urb-c2',
+    'Rb-orig', 'Rb-c1', 'Rb-c2',
+    'Ash-orig', 'Ash-c1', 'Ash-c2',
+    'Ham-orig', 'Ham-c1', 'Ham-c2',
+    'Mart-orig', 'Mart-c1', 'Mart-c2-1',
+    'LauSC-orig', 'LauSC-c1', 'LauSC-c2', 'LauSC-c3', 'LauSC-c4',
+    'Triv-orig', 'Triv-c1', 'Triv-c2',
+    'PET', 'FS', 'LEO',]
+
+def verse_filenames(maxfiles, in_path):
+    # sorted list of all json filenames, up to `maxfiles`; sorting before
+    # slicing makes partial runs deterministic
+    filenames = sorted(glob.glob('%s/*.json' % in_path))
+
+    return filenames[:maxfiles]
+
+def parse_verse(filename):
+    # extract cantica, canto and verso info
+    bname = os.path.basename(filename).split('.')[0]
+    canto, cantica, verso = bname.split('_')
+
+    # parse json
+    logging.info("Parsing %s...", filename)
+    with instrument.stage('parse_json'):
+        with open(filename) as json_handler:
+            data = json.load(json_handler)
+
+    # iterate over all characters (in phylogenetics parlance, usually
+    # textual words) for the current verse, collecting (label, states)
+    # tuples in the order of the transcription
+    loci = []
+    with instrument.stage('normalize'):
+        for i, character in enumerate(data):
+            label = '%s_%s_%s_%s' % (CANTICA[canto], cantica, verso, i)
+
+            states = {}
+            for state in character:
+                # correct omissions and gaps
+                if state in ['*om.**', ' *om.** ']:
+                    state_norm = '{{?}}'
+                elif state == '_':
+                    state_norm = '{{-}}'
+                else:
+                    state_norm = fix_state_label(state)
+
+                # add to current list of states
+                states[state_norm] = character[state]
+
+            loci.append((label, states))
+
+    return loci
+
+def parse_verse_stats(filename, totals=False):
+    # parse a verse, also returning the normalizer statistics for it, as
+    # verses are usually parsed in other processes, and, with `totals`,
+    # the instrumentation totals of the (worker) process, or else None
+    before = _normalize_label.cache_info()
+    loci = parse_verse(filename)
+
+    return (loci, normalizer_delta(before),
+        instrument.totals() if totals else None)
+
+def normalizer_digest():
+    # digest of the version and tables of the state label normalization, so
+    # that cached verses are invalidated whenever they change; only stable
+    # inputs are used (the constants of the code include the lambda, whose
+    # repr has a memory address), so the digest is the same in every run
+    sha = hashlib.sha1(str(NORMALIZER_VERSION).encode('utf-8'))
+    sha.update(repr(sorted(SIMPLE_FIXES.items())).encode('utf-8'))
+    sha.update(repr(sorted(ENTITIES.items())).encode('utf-8'))
+
+    return sha.digest()
+
+# cached verses are named after their key, a SHA-1 hex digest
+VERSE_KEY_RE = re.compile(r'^[0-9a-f]{40}$')
+
+def verse_key(filename, digest):
+    # cache key of a verse file, from its name, its contents and the
+    # normalizer digest; the name is needed, as the labels of the cached
+    # loci are taken from it, and different verses can have the same
+    # contents
+    sha = hashlib.sha1(digest)
+    sha.update(os.path.basename(filename).encode('utf-8') + b'\0')
+    with open(filename, 'rb') as handler:
+        sha.update(handler.read())
+
+    return sha.hexdigest()
+
+def _load_pickle(filename):
+    # load a cached object, returning None if missing or unreadable
+    try:
+        with open(filename, 'rb') as handler:
+            return pickle.load(handler)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+def _dump_pickle(obj, filename):
+    tmp_file = '%s.%i.tmp' % (filename, os.getpid())
+    with open(tmp_file, 'wb') as handler:
+        pickle.dump(obj, handler, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, filename)
+
+def iter_verses(filenames, processes=None, chunksize=16, cache_dir=None):
+    # yield (filename, key, loci) for every verse file, in order; verse
+    # files are parsed by a pool of `processes` workers (all cpus by
+    # default, no pool if 1), and `imap` keeps the results in the sorted
+    # order of filenames, so that the output is the same as a serial run;
+    # when a `cache_dir` is given, verses whose contents did not change are
+    # loaded from there (the key is None if there is no cache)
+    keys = [None] * len(filenames)
+    misses = filenames
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        digest = normalizer_digest()
+        keys = [verse_key(filename, digest) for filename in filenames]
+        misses = [filename for filename, key in zip(filenames, keys)
+            if not os.path.exists(os.path.join(cache_dir, key + '.pickle'))]
+        logging.info('%i of %i verses not cached', len(misses), len(filenames))
+
+    pool = None
+    if processes == 1 or len(misses) < 2:
+        parsed = map(parse_verse_stats, misses)
+    else:
+        pool = multiprocessing.Pool(processes, instrument.init_worker,
+            (instrument.enabled(),))
+        parsed = pool.imap(functools.partial(parse_verse_stats, totals=True),
+            misses, chunksize)
+
+    try:
+        miss_set = set(misses)
+        for filename, key in zip(filenames, keys):
+            if filename not in miss_set:
+                loci = _load_pickle(os.path.join(cache_dir, key + '.pickle'))
+                if loci is not None:
+                    instrument.count('cached_files')
+                    yield filename, key, loci
+                    continue
+                # unreadable cache entry, parse again
+                loci, delta, totals = parse_verse_stats(filename)
+            else:
+                loci, delta, totals = next(parsed)
+            merge_normalizer_stats(delta)
+            if totals:
+                instrument.merge(totals)
+
+            if cache_dir:
+                _dump_pickle(loci, os.path.join(cache_dir, key + '.pickle'))
+            yield filename, key, loci
+    finally:
+        if pool:
+            pool.terminate()
+
+def iter_loci(maxfiles, in_path, processes=None, chunksize=16):
+    # yield (label, states) for every locus, one at a time
+    filenames = verse_filenames(maxfiles, in_path)
+    for _, _, loci in iter_verses(filenames, processes, chunksize):
+        yield from loci
+
+def read_data(maxfiles, in_path, include_leo=True, descripti=[],
+              processes=None, cache_dir=None):
     ret = {
         'chars' : {},
         'witnesses' : set(), # LEO not in raw data
@@ -57,189 +230,402 @@ def read_data(maxfiles, in_path, include_leo=True, descripti=[]):
     if include_leo:
         ret['witnesses'].add('LEO')
 
-    # iterate over all json filenames, up to `maxfiles`
-    filenames = glob.glob('%s/*.json' % in_path)
-    for filename in sorted(filenames[:maxfiles]):
-        # extract cantica, canto and verso info
-        bname = os.path.basename(filename).split('.')[0]
-        canto, cantica, verso = bname.split('_')
-
-        # parse json
-        logging.info("Parsing %s...", filename)
-        with open(filename) as json_handler:
-            data = json.load(json_handler)
+    # verse filename -> (key, labels), to find out what changed since each
+    # output was last built with the same cache
+    verses = {}
+
+    # all witnesses found in the data; the descripti are removed once, at
+    # the end
+    found = set()
+
+    filenames = verse_filenames(maxfiles, in_path)
+    for filename, key, loci in iter_verses(filenames, processes,
+                                           cache_dir=cache_dir):
+        verses[filename] = (key, [label for label, _ in loci])
+        instrument.count('files')
+        instrument.count('loci', len(loci))
+
+        for label, states in loci:
+            for witnesses in states.values():
+                found.update(witnesses)
+
+            # add LEOnardi, defaulting to PETrocchi
+            if include_leo:
+                if label in LEONARDI:
+                    leo_label = fix_state_label(LEONARDI[label])
+                    states[leo_label].append('LEO')
+                else:
+                    for pet_label in states:
+                        if 'PET' in states[pet_label]:
+                            states[pet_label].append('LEO')
+
+            # add to returned data
+            ret['chars'][label] = states
+            instrument.count('states', len(states))
+
+    with instrument.stage('remove_descripti'):
+        ret['witnesses'].update(found.difference(descripti))
+
+    # snapshot of the data read, stored by `output_data()` with the matrix
+    # of each output, so that every output is compared with the data it
+    # was actually built from
+    if cache_dir:
+        ret['manifest'] = {
+            'verses' : verses,
+            'leonardi' : dict(LEONARDI) if include_leo else {},
+        }
+        prune_verses(cache_dir, set([key for key, _ in verses.values()]))
 
-            # iterate over all characters (in phylogenetics parlance, usually
-            # textual words) for the current verse
-            for i, character in enumerate(data):
-                # create matrix of results
-                label = '%s_%s_%s_%s' % (CANTICA[canto], cantica, verso, i)
+    return ret
 
-                states = {}
-                for state in character:
-                    # correct omissions and gaps
-                    if state in ['*om.**', ' *om.** ']:
-                        state_norm = '{{?}}'
-                    elif state == '_':
-                        state_norm = '{{-}}'
-                    else:
-                        state_norm = fix_state_label(state)
-
-                    # add to current list of states
-                    states[state_norm] = character[state]
-
-                    # append all non-descripti witnesses
-                    for l in states:
-                        for w in states[l]:
-                            if w not in descripti:
-                                ret['witnesses'].add(w)
-
-                # add LEOnardi, defaulting to PETrocchi
-                if include_leo:
-                    if label in LEONARDI:
-                        leo_label = fix_state_label(LEONARDI[label])
-                        states[leo_label].append('LEO')
-                    else:
-                        for pet_label in states:
-                            if 'PET' in states[pet_label]:
-                                states[pet_label].append('LEO')
+def changed_loci(previous, manifest):
+    # set of the labels of the loci that changed between two manifests of
+    # `read_data()` (None if unknown): those in verses whose contents
+    # changed, were added, or were removed, and those whose LEOnardi
+    # reading changed (if included); the descripti do not change the parsed
+    # data, and are dealt with by each output
+    if previous is None or manifest is None:
+        return None
+
+    changed = set()
+    verses = manifest['verses']
+    for filename in set(verses) | set(previous['verses']):
+        key, labels = verses.get(filename, (None, []))
+        prev_key, prev_labels = previous['verses'].get(filename, (None, []))
+        if key != prev_key:
+            changed.update(labels)
+            changed.update(prev_labels)
+
+    for label in set(manifest['leonardi']) | set(previous['leonardi']):
+        if manifest['leonardi'].get(label) != previous['leonardi'].get(label):
+            changed.add(label)
+
+    return changed
+
+def prune_verses(cache_dir, keys):
+    # remove the cached verses whose key is not in `keys` (those of files
+    # edited or removed, or parsed by an older normalizer), so that the
+    # cache does not grow with every change
+    for filename in glob.glob(os.path.join(cache_dir, '*.pickle')):
+        key = os.path.basename(filename)[:-len('.pickle')]
+        if VERSE_KEY_RE.match(key) and key not in keys:
+            os.remove(filename)
+
+# fallback chains for the witnesses without a reading in a locus, as
+# templates over the manuscript name: `build_matrix()` tries the base
+# manuscript (e.g., 'Ash-c2'->'Ash'), then its original text, then the
+# first hand (which should only happen if there are problems in data),
+# while `output_data2()` tries the original text first
+FALLBACKS = ('{}', '{}-orig', '{}-c1')
+FALLBACKS2 = ('{}-orig', '{}')
+
+@functools.lru_cache(maxsize=None)
+def fallback_chain(witness, fallbacks=FALLBACKS):
+    # the witnesses whose reading is used, in order, when `witness` has
+    # none, e.g. ('Ash', 'Ash-orig', 'Ash-c1') for 'Ash-c2'
+    manuscript = witness.split('-')[0]
+    chain = [template.format(manuscript) for template in fallbacks]
+
+    return tuple([w for w in chain if w != witness])
+
+def resolve_readings(states, chains):
+    # witness -> state label for a locus, for all the witnesses in `chains`
+    # (a list of (witness, fallback chain)): attested readings first, then
+    # the first attested reading in the chain of each witness, or missing
+    # data; defaults are never used as sources, so that the order of the
+    # witnesses does not matter; the `defaults` of the witnesses without a
+    # reading are also returned on their own
+    attested = {}
+    for label, witnesses in states.items():
+        for w in witnesses:
+            attested[w] = label
+
+    defaults = {}
+    for w, chain in chains:
+        if w in attested:
+            continue
+        for source in chain:
+            if source in attested:
+                defaults[w] = attested[source]
+                break
+        else:
+            defaults[w] = '{{?}}'
+
+    readings = attested
+    readings.update(defaults)
+
+    return readings, defaults
+
+def witness_masks(data):
+    # bit masks of witnesses for a collation (or a view): `bits` maps each
+    # witness to its bit, over the sorted witnesses of `data` (others get
+    # the next bits, as found), and `chars` caches the masks of the states
+    # of each character, computed when first needed by `state_masks()`;
+    # the masks are never stored in `data`, but can be shared by all the
+    # views of the same (unchanged) collation, see `collation_view()`
+    return {
+        'bits' : dict((w, 1 << idx)
+            for idx, w in enumerate(sorted(data['witnesses']))),
+        'chars' : {},
+    }
 
-                # add to returned data
-                ret['chars'][label] = states
+def witness_mask(masks, witnesses):
+    # bit mask of a collection of witnesses
+    bits = masks['bits']
+    mask = 0
+    for w in witnesses:
+        if w not in bits:
+            bits[w] = 1 << len(bits)
+        mask |= bits[w]
+
+    return mask
+
+def state_masks(masks, ch, states):
+    # state label -> mask of its witnesses, for the `states` of a character
+    ret = masks['chars'].get(ch)
+    if ret is None:
+        ret = dict((state, witness_mask(masks, state_witnesses))
+            for state, state_witnesses in states.items())
+        masks['chars'][ch] = ret
 
     return ret
 
-def output_data(data, out_file, descripti=[], extra_data=None):
-    # sorted list of characters
-    chars = sorted(data['chars'])
+def attested_states(masks, ch, states, mask):
+    # states of a character attested by any of the witnesses in `mask`, so
+    # that removing descripti (or selecting any subset of witnesses) drops
+    # the states left without witnesses
+    return [state for state, state_mask in
+        state_masks(masks, ch, states).items() if state_mask & mask]
 
-    # collect additional data, witness->statelabel readings
-    readings = {}
-    for ch in chars:
-        # build witness -> text for this char, first attested readings...
-        readings[ch] = {}
-        for k, v in data['chars'][ch].items():
-            for w in v:
-                readings[ch][w] = k
-
-        # ...then, non attested, using defaults, test all witnesses
-        for w in data['witnesses']:
-            if w not in readings[ch]:
-                # when there is a missing witness, separate the manuscript
-                # from the revision and try them in order
-                manuscript = w.split('-')[0]
-
-                if manuscript in readings[ch]:
-                    # try the base name first (e.g., 'Ash-c2'->'Ash')
-                    lesson = readings[ch][manuscript]
-                    readings[ch][w] = lesson
-                    if lesson != '{{?}}':
-                        data['chars'][ch][lesson].append(w)
-                elif manuscript+'-orig' in readings[ch]:
-                    # try '-orig' (e.g., 'Ash'->'Ash-orig'; 'Ash-c2'->'Ash')
-                    lesson = readings[ch][manuscript+'-orig']
-                    readings[ch][w] = lesson
-                    if lesson != '{{?}}':
-                        data['chars'][ch][lesson].append(w)
-                elif manuscript+'-c1' in readings[ch]:
-                    # try the first hand (should only get here if there are
-                    # problems in data)
-                    lesson = readings[ch][manuscript+'-c1']
-                    readings[ch][w] = lesson
-                    if lesson != '{{?}}':
-                        data['chars'][ch][lesson].append(w)
-                else:
-                    # default to missing
-                    readings[ch][w] = '{{?}}'
-                    logging.warning('missing data: in %s char %s', w, ch)
-
-    # remove descripti states (if provided)
-    if descripti:
-        # remove descript from all states
-        for char in chars:
-            # casting to list to avoid the 'dictionary changed size
-            # during iteration' error
-            for state in list(data['chars'][char]):
-                data['chars'][char][state] = \
-                    [w for w in data['chars'][char][state] if w not in descripti]
-
-                # remove all empty states
-                if len(data['chars'][char][state]) == 0:
-                    del data['chars'][char][state]
+# number of columns built at a time by `build_matrix()`, which goes through
+# the steps (each timed as a stage) for a block of columns before the next;
+# larger blocks keep more readings in memory, and are slower
+COLUMN_BLOCK = 64
 
-    # sorted manuscripts' names
-    witnesses = sorted([w for w in data['witnesses'] if w not in descripti])
+def build_matrix(data, descripti=[], previous=None, changed=None):
+    # sorted list of characters and manuscripts' names
+    chars = sorted(data['chars'])
+    witnesses = sorted(set(data['witnesses']).difference(descripti))
+
+    # state codes for gaps and missing data
+    special_codes = {'{{?}}' : charmatrix.MISSING, '{{-}}' : charmatrix.GAP}
+
+    # when given a `previous` matrix built from the same view, with the same
+    # characters and witnesses, only the columns of the loci that `changed`
+    # since then are rebuilt
+    if previous is not None and changed is not None and \
+            previous['chars'] == chars and previous['taxa'] == witnesses:
+        matrix = charmatrix.new_matrix(witnesses, chars,
+            previous['state_labels'])
+        matrix['rows'] = dict((w, bytearray(previous['rows'][w]))
+            for w in witnesses)
+        columns = [(c_idx, ch) for c_idx, ch in enumerate(chars)
+            if ch in changed]
+    else:
+        matrix = charmatrix.new_matrix(witnesses, chars, [None] * len(chars))
+        columns = enumerate(chars)
+
+    # the state labels are collected for each character as we go, so that
+    # only the readings of the current character are kept in memory; the
+    # input data is never changed, as it might be shared by many views
+    rows = [matrix['rows'][w] for w in witnesses]
+
+    # states are only kept if attested by a witness in the `keep` mask,
+    # i.e., not by the `descripti` alone or, in views with `drop_states`
+    # (see `witness_subset()`), by a selected witness; the masks of the
+    # view are used, if any, so that those of the states of each character
+    # are computed once for all the views sharing them
+    keep = None
+    if descripti or data.get('drop_states'):
+        masks = data.get('masks') or witness_masks(data)
+        if descripti:
+            keep = ~witness_mask(masks, descripti)
+        else:
+            keep = witness_mask(masks, witnesses)
+
+    # the fallback chain of each witness is built once for all columns
+    chains = [(w, fallback_chain(w)) for w in witnesses]
+    columns = list(columns)
+    for start in range(0, len(columns), COLUMN_BLOCK):
+        block = columns[start:start+COLUMN_BLOCK]
+
+        # build witness -> text for each char, with defaults for the
+        # witnesses without a reading
+        with instrument.stage('fill_defaults'):
+            resolved = []
+            for c_idx, ch in block:
+                readings, defaults = resolve_readings(data['chars'][ch],
+                    chains)
+                unresolved = [w for w, state in defaults.items()
+                    if state == '{{?}}']
+                for w in unresolved:
+                    instrument.warning('missing data', 'in %s char %s', w, ch)
+                instrument.count('missing_fallbacks', len(unresolved))
+                resolved.append((readings, defaults))
+
+        # only keep the states attested by a witness in `keep`, or
+        # defaulted to by a witness without a reading
+        block_states = [data['chars'][ch].keys() for _, ch in block]
+        if keep is not None:
+            with instrument.stage('remove_descripti'):
+                for idx, (c_idx, ch) in enumerate(block):
+                    kept = set(attested_states(masks, ch, data['chars'][ch],
+                        keep))
+                    kept.update(resolved[idx][1].values())
+                    block_states[idx] = [s for s in block_states[idx]
+                        if s in kept]
+
+        with instrument.stage('state_labels'):
+            for (c_idx, _), states in zip(block, block_states):
+                matrix['state_labels'][c_idx] = sorted([s for s in states
+                    if s not in special_codes])
+
+        # state label -> code, and fill the columns
+        with instrument.stage('fill_columns'):
+            for (c_idx, _), (readings, _) in zip(block, resolved):
+                codes = dict(special_codes)
+                codes.update((s, idx) for idx, s in
+                    enumerate(matrix['state_labels'][c_idx]))
+                for row, w in zip(rows, witnesses):
+                    row[c_idx] = codes[readings[w]]
+
+    return matrix
+
+def output_matrix(matrix, out_file, extra_data=None):
+    witnesses = matrix['taxa']
+    chars = matrix['chars']
     taxon_labels = ' '.join([w.replace('-', '_') for w in witnesses])
-
-    # collect additional data, state labels, number of states
-    state_labels = {}    
-    max_states = 0
-    for char in chars:
-        states = data['chars'][char].keys()
-        states = [s for s in states if s not in ['{{?}}', '{{-}}']]
-
-        state_labels[char] = sorted(states)
-
-        if len(states) > max_states:
-            max_states = len(states)
-
+    max_states = charmatrix.max_states(matrix)
     symbols_str = ' '.join([str(v) for v in range(max_states+1)])
 
-    # output data
-    nexus = open(out_file, 'w')
-
-    nexus.write('#NEXUS\n\n')
-
-    nexus.write('BEGIN TAXA;\n')
-    nexus.write('\tDIMENSIONS NTAX=%i;\n' % len(witnesses))
-    nexus.write('\tTAXLABELS\n')
-    nexus.write('\t\t%s\n' % taxon_labels)
-    nexus.write('\t;\n')
-    nexus.write('END;\n\n')
-
-    print(out_file, 'taxa', len(witnesses), taxon_labels)
-
-    nexus.write('BEGIN CHARACTERS;\n')
-    nexus.write('\tDIMENSIONS  NCHAR=%i;\n' % len(chars))
-    nexus.write('\tFORMAT DATATYPE=STANDARD GAP=- MISSING=? ')
-    nexus.write('SYMBOLS="%s";\n' % symbols_str)
-
-    print(out_file, 'characters', len(chars), symbols_str)
-
-    nexus.write('\tCHARSTATELABELS\n')
-    for c_idx, char in enumerate(chars):
-        sl_str = ' '.join(state_labels[char])
-        nexus.write('\t\t%i %s / %s ,\n' % (c_idx+1, char, sl_str))
-    nexus.write('\t;\n')
-
-    nexus.write('\tMATRIX\n')
-    for witness in witnesses:
-        state_buffer = ''
-        for char in chars:
-            r = readings[char][witness]
-            if r in ['{{?}}', '{{-}}']:
-                s = r[2]
-            else:
-                s = str(state_labels[char].index(r))
-
-            state_buffer += s
-
-        # output buffer 
-        nexus.write('\t%s  %s\n' % (witness.replace('-', '_'), state_buffer))
-
-        print(out_file, witness, len(state_buffer), state_buffer[:10])
-
-
-    # end of matrix
-    nexus.write(';\nEND;\n\n')
-
-    if extra_data:
-        nexus.write('\n')
-        nexus.write(extra_data)
-        nexus.write('\n')
-
-    nexus.close()
-
+    # output data, buffered and written to a temporary file which replaces
+    # `out_file` only when complete (compressed if it ends in '.gz' or
+    # '.zst'), so that readers never find a partial matrix
+    with nexusio.open_output(out_file) as nexus:
+        nexus.write('#NEXUS\n\n')
+
+        nexus.write('BEGIN TAXA;\n')
+        nexus.write('\tDIMENSIONS NTAX=%i;\n' % len(witnesses))
+        nexus.write('\tTAXLABELS\n')
+        nexus.write('\t\t%s\n' % taxon_labels)
+        nexus.write('\t;\n')
+        nexus.write('END;\n\n')
+
+        nexus.write('BEGIN CHARACTERS;\n')
+        nexus.write('\tDIMENSIONS  NCHAR=%i;\n' % len(chars))
+        nexus.write('\tFORMAT DATATYPE=STANDARD GAP=- MISSING=? ')
+        nexus.write('SYMBOLS="%s";\n' % symbols_str)
+
+        nexus.write('\tCHARSTATELABELS\n')
+        nexus.write(''.join(['\t\t%i %s / %s ,\n' % (c_idx+1, char,
+            ' '.join(sl)) for c_idx, (char, sl) in
+            enumerate(zip(chars, matrix['state_labels']))]))
+        nexus.write('\t;\n')
+
+        nexus.write('\tMATRIX\n')
+        for witness in witnesses:
+            state_buffer = charmatrix.row_symbols(matrix, witness)
+            nexus.write('\t%s  %s\n' % (witness.replace('-', '_'),
+                state_buffer))
+
+        # end of matrix
+        nexus.write(';\nEND;\n\n')
+
+        # weights of compressed site patterns, if any
+        if 'weights' in matrix:
+            nexus.write(weights_block(matrix))
+
+        if extra_data:
+            nexus.write('\n')
+            nexus.write(extra_data)
+            nexus.write('\n')
+
+    # summary of the file, instead of reporting every row
+    logging.info('%s: %i taxa, %i characters', out_file, len(witnesses),
+        len(chars))
+
+    return {'out_file' : out_file, 'taxa' : len(witnesses),
+        'chars' : len(chars)}
+
+def weights_block(matrix):
+    # ASSUMPTIONS block with the weights of compressed site patterns, as
+    # returned by `charmatrix.compress_patterns()`
+    wtsets = charmatrix.weights_sets(matrix['weights'])
+    wtset = ', '.join(['%i: %s' % (weight, ' '.join([str(c) for c in chars]))
+        for weight, chars in sorted(wtsets.items())])
+
+    buf = 'BEGIN ASSUMPTIONS;\n'
+    buf += '\t[%i sites, %i invariant]\n' % (
+        matrix['sites'], matrix['invariant'])
+    buf += '\tWTSET * patterns = %s;\n' % wtset
+    buf += '\t[original loci of each pattern]\n'
+    buf += ''.join(['\t%s\n' % comment
+        for comment in charmatrix.loci_comments(matrix['loci'])])
+    buf += 'END;\n\n'
+
+    return buf
+
+def output_data(data, out_file, descripti=[], extra_data=None,
+                compress=False, drop_invariant=False, cache_dir=None,
+                trees=None):
+    # when a `cache_dir` is given, the matrix of the previous run for the
+    # same `out_file` is reused if it was built from the same witnesses,
+    # descripti and dropping of states (as they change the defaults and
+    # the states),
+    # rebuilding the loci changed since the manifest of the data it was
+    # built from; it is stored with the current manifest only once the
+    # file is written, so that an interrupted run is never taken as done
+    previous = changed = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir,
+            '%s.matrix.pickle' % os.path.basename(out_file))
+        signature = (sorted(data['witnesses']), sorted(descripti),
+            bool(data.get('drop_states')))
+        cached = _load_pickle(cache_file)
+        if cached and cached['signature'] == signature:
+            previous = cached['matrix']
+            changed = changed_loci(cached.get('manifest'),
+                data.get('manifest'))
+            if changed is not None:
+                logging.info('%s: %i loci changed since the last run',
+                    out_file, len(changed))
+
+    with instrument.stage('build_matrix'):
+        matrix = build_matrix(data, descripti, previous, changed)
+    full_matrix = matrix
+
+    # distance trees built from the full matrix, as a list of (name,
+    # function), such as `treebuild.nj_tree`, added to the Trees block of
+    # `extra_data` (or to a new one)
+    if trees:
+        with instrument.stage('trees'):
+            extra_data = treebuild.add_trees(extra_data or '',
+                [(name, build(matrix)) for name, build in trees])
+
+    # when compressing, identical columns are collapsed into weighted site
+    # patterns (optionally dropping the invariant ones)
+    if compress:
+        with instrument.stage('compress'):
+            matrix = charmatrix.compress_patterns(matrix, drop_invariant)
+
+    with instrument.stage('output_matrix'):
+        summary = output_matrix(matrix, out_file, extra_data)
+
+    if cache_dir:
+        _dump_pickle({'signature' : signature, 'matrix' : full_matrix,
+            'manifest' : data.get('manifest')}, cache_file)
+
+    return summary
+
+def output_phylip(matrix, out_file):
+    # relaxed (sequential) PHYLIP, with taxon names padded to a common width
+    width = max([len(w) for w in matrix['taxa']] + [9]) + 1
+
+    with nexusio.open_output(out_file) as phylip:
+        phylip.write('%i %i\n' % (len(matrix['taxa']), len(matrix['chars'])))
+        for witness in matrix['taxa']:
+            phylip.write('%s%s\n' % (witness.replace('-', '_').ljust(width),
+                charmatrix.row_symbols(matrix, witness)))
 
 def read_data2(maxfiles, in_path):
     ret = {
@@ -323,37 +709,93 @@ def read_data2(maxfiles, in_path):
 
     return ret
 
-def fix_state_label(label):
-    # simple fixes
-    label = label.replace(' ', '_')
-    label = label.replace('**', ']')
-    label = label.replace('*', '[')
-
-    # manually fix unicode escape problems - as there is no consistency in
-    # some transcriptions, this needs to be performed "by hand" on all
-    # escaped points
-    REPLACES = [
-        ['&middot;', '·'],
-        ['&ugrave;', 'ù'],
-        ['&ograve;', 'ò'],
-        ['&#x0303;', '~'], # replacing but normal (not combining) tilde
-        ['&#x00F5;', 'õ'],
-        ['&#x0103;', 'ă'],
-        ['&nbsp;', '_'],   # replacing by underscore, as spaces are separators
-        ['&#x014D;', 'ō'],
-        ['&#x016B;', 'ū'],
-        ['&#x012B;', 'ī'],
-        ['&#xF145;', 'm'], # error in the trancription
-        ['&#x0113;', 'ē'],
-        ['&#x0304;', '-'], # replacing combining macro
-        ['&#xF147;', '[p]'], # error in trascription, Z_28_055_5
-    ]
-
-    for replace in REPLACES:
-        label = label.replace(replace[0], replace[1])
+# simple fixes, applied after replacing '**' by ']'
+SIMPLE_FIXES = str.maketrans({' ' : '_', '*' : '['})
+
+# manually fix unicode escape problems - as there is no consistency in
+# some transcriptions, this needs to be performed "by hand" on all
+# escaped points
+ENTITIES = {
+    '&middot;' : '·',
+    '&ugrave;' : 'ù',
+    '&ograve;' : 'ò',
+    '&#x0303;' : '~', # replacing but normal (not combining) tilde
+    '&#x00F5;' : 'õ',
+    '&#x0103;' : 'ă',
+    '&nbsp;' : '_',   # replacing by underscore, as spaces are separators
+    '&#x014D;' : 'ō',
+    '&#x016B;' : 'ū',
+    '&#x012B;' : 'ī',
+    '&#xF145;' : 'm', # error in the trancription
+    '&#x0113;' : 'ē',
+    '&#x0304;' : '-', # replacing combining macro
+    '&#xF147;' : '[p]', # error in trascription, Z_28_055_5
+}
+ENTITY_RE = re.compile('|'.join([re.escape(e) for e in ENTITIES]))
+UNKNOWN_ENTITY_RE = re.compile(r'&#?\w+;')
+
+# version of `_normalize_label()`, to be increased whenever its code
+# changes, so that the verses cached by `tonexus()` are parsed again
+NORMALIZER_VERSION = 1
+
+# most forms ("che", "la", "di") repeat thousands of times, so normalized
+# labels are memoized
+NORMALIZER_CACHE_SIZE = 1 << 16
+
+# statistics of the normalizer (cache hits and misses, and unknown entities
+# found in distinct labels), merged from all the processes parsing verses
+NORMALIZER_STATS = {
+    'hits' : 0,
+    'misses' : 0,
+    'unknown' : collections.Counter(),
+}
+
+# unknown entities found by this process and not merged yet
+_unknown_entities = collections.Counter()
+
+@functools.lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def _normalize_label(label):
+    label = label.replace('**', ']').translate(SIMPLE_FIXES)
+    label = ENTITY_RE.sub(lambda match: ENTITIES[match.group(0)], label)
+
+    for entity in UNKNOWN_ENTITY_RE.findall(label):
+        logging.debug('unknown entity %s in %s', entity, label)
+        _unknown_entities[entity] += 1
 
     return label
 
+def fix_state_label(label):
+    return _normalize_label(label)
+
+def normalizer_delta(before):
+    # statistics of this process since `before` (a `cache_info()`),
+    # consuming the unknown entities not merged yet
+    after = _normalize_label.cache_info()
+    delta = {
+        'hits' : after.hits - before.hits,
+        'misses' : after.misses - before.misses,
+        'unknown' : collections.Counter(_unknown_entities),
+    }
+    _unknown_entities.clear()
+
+    return delta
+
+def merge_normalizer_stats(delta):
+    NORMALIZER_STATS['hits'] += delta['hits']
+    NORMALIZER_STATS['misses'] += delta['misses']
+    NORMALIZER_STATS['unknown'].update(delta['unknown'])
+
+def normalizer_stats():
+    # report the hit rate of the normalizer and the unknown entities
+    calls = NORMALIZER_STATS['hits'] + NORMALIZER_STATS['misses']
+    return {
+        'calls' : calls,
+        'hits' : NORMALIZER_STATS['hits'],
+        'misses' : NORMALIZER_STATS['misses'],
+        'hit_rate' : NORMALIZER_STATS['hits'] / calls if calls else 0.0,
+        'unknown' : dict(NORMALIZER_STATS['unknown']),
+    }
+
 def output_data2(data, out_file, tree_str=None):
     # sorted manuscripts' names
     witnesses = sorted(data['matrix'].keys())
@@ -370,100 +812,121 @@ def output_data2(data, out_file, tree_str=None):
     n_char = len(out_chars) #len(data['char_desc']) - data['single_states']
 
     # output data
-    nexus = open(out_file, 'w')
-
-    nexus.write('#NEXUS\n\n')
-
-    nexus.write('BEGIN TAXA;\n')
-    nexus.write('\tDIMENSIONS NTAX=%i;\n' % len(witnesses))
-    nexus.write('\tTAXLABELS\n')
-    nexus.write('\t\t%s\n' % taxon_labels)
-    nexus.write('\t;\n')
-    nexus.write('END;\n\n')
-
-    nexus.write('BEGIN CHARACTERS;\n')
-    nexus.write('\tDIMENSIONS  NCHAR=%i;\n' % n_char)
-    nexus.write('\tFORMAT DATATYPE=STANDARD GAP=- MISSING=? ')
-    nexus.write('SYMBOLS="%s";\n' % symbols_str)
-
-    nexus.write('\tCHARSTATELABELS\n')
-    for c_idx, char_label in enumerate(out_chars):
-        # extract an ordered list of states for the currenct character
-        # (so that we will write them in order), excluding gaps and missing
-        # data
-        states = [s for s in data['char_desc'][char_label].keys()]
-        states = sorted([s for s in states if s not in ['-', '?']])
-
-        # extract the text for all states collected above and build a list
-        # of them, replacing white spaces by underscores (as the space is
-        # used as delimiter by the NEXUS format here) and other fixes
-        state_labels = [data['char_desc'][char_label][s] for s in states]
-        state_labels = ' '.join([fix_state_label(l) for l in state_labels])
-
-        nexus.write('\t\t%i %s / %s ,\n' % (c_idx+1, char_label, state_labels))
-    nexus.write('\t;\n')
-
-    nexus.write('\tMATRIX\n')
-    for witness in witnesses:
-        # build buffer
-        w_states = ''
-        for char in out_chars:
-            if char not in data['matrix'][witness]:
-
-                # when there is a missing witness, separate the manuscript
-                # from the revision and try them in order
-                manuscript = witness.split('-')[0]
-
-                solved = False
-
-                if manuscript+'-orig' in witnesses:
-                    # try 'orig' first
-                    if char in data['matrix'][manuscript+'-orig']:
-                        w_states += data['matrix'][manuscript+'-orig'][char]
-                        solved = True
-
-                if not solved and manuscript in witnesses:
-                    # try non revised manuscript
-                    if char in data['matrix'][manuscript]:
-                        w_states += data['matrix'][manuscript][char]
-                        solved = True
-
-                if not solved:
-                    w_states += '?'
-                    logging.warning('missing data: in %s char %s', witness, char)
+    with nexusio.open_output(out_file) as nexus:
+        nexus.write('#NEXUS\n\n')
+
+        nexus.write('BEGIN TAXA;\n')
+        nexus.write('\tDIMENSIONS NTAX=%i;\n' % len(witnesses))
+        nexus.write('\tTAXLABELS\n')
+        nexus.write('\t\t%s\n' % taxon_labels)
+        nexus.write('\t;\n')
+        nexus.write('END;\n\n')
+
+        nexus.write('BEGIN CHARACTERS;\n')
+        nexus.write('\tDIMENSIONS  NCHAR=%i;\n' % n_char)
+        nexus.write('\tFORMAT DATATYPE=STANDARD GAP=- MISSING=? ')
+        nexus.write('SYMBOLS="%s";\n' % symbols_str)
+
+        nexus.write('\tCHARSTATELABELS\n')
+        for c_idx, char_label in enumerate(out_chars):
+            # extract an ordered list of states for the currenct character
+            # (so that we will write them in order), excluding gaps and missing
+            # data
+            states = [s for s in data['char_desc'][char_label].keys()]
+            states = sorted([s for s in states if s not in ['-', '?']])
+
+            # extract the text for all states collected above and build a list
+            # of them, replacing white spaces by underscores (as the space is
+            # used as delimiter by the NEXUS format here) and other fixes
+            state_labels = [data['char_desc'][char_label][s] for s in states]
+            state_labels = ' '.join([fix_state_label(l) for l in state_labels])
+
+            nexus.write('\t\t%i %s / %s ,\n' % (c_idx+1, char_label,
+                state_labels))
+        nexus.write('\t;\n')
+
+        nexus.write('\tMATRIX\n')
+        for witness in witnesses:
+            # build buffer
+            w_states = ''
+            for char in out_chars:
+                if char not in data['matrix'][witness]:
+                    # when there is a missing witness, try the other layers of
+                    # the manuscript in order
+                    for source in fallback_chain(witness, FALLBACKS2):
+                        if source in data['matrix'] and \
+                                char in data['matrix'][source]:
+                            w_states += data['matrix'][source][char]
+                            break
+                    else:
+                        w_states += '?'
+                        instrument.warning('missing data', 'in %s char %s',
+                            witness, char)
 
-            else:
-                w_states += data['matrix'][witness][char]
-
-        # output buffer
-        nexus.write('\t%s  %s\n' % (witness.replace('-', '_'), w_states))
-    # end of matrix
-    nexus.write(';\nEND;\n\n')
-
-    if tree_str:
-        nexus.write('\n\n')
-        nexus.write(tree_str)
-        nexus.write('\n\n')
-
-    nexus.close()
-
-def tonexus(maxfiles=None, in_path='data/transcription', out_path='data'):
-    # read all data and output
-    data = read_data(maxfiles, in_path, include_leo=True)
-    output_data(data, '%s/tresoldi.nex' % out_path)
-
-    # set descripti, read new data and output reduced
-    descripti = [
-        'Urb-orig', 'Urb-c1', 'Urb-c2',
-        'Rb-orig', 'Rb-c1', 'Rb-c2',
-        'Ash-orig', 'Ash-c1', 'Ash-c2',
-        'Ham-orig', 'Ham-c1', 'Ham-c2',
-        'Mart-orig', 'Mart-c1', 'Mart-c2-1',
-        'LauSC-orig', 'LauSC-c1', 'LauSC-c2', 'LauSC-c3', 'LauSC-c4',
-        'Triv-orig', 'Triv-c1', 'Triv-c2',
-        'PET', 'FS', 'LEO',]
-
-    trees_str = """
+                else:
+                    w_states += data['matrix'][witness][char]
+
+            # output buffer
+            nexus.write('\t%s  %s\n' % (witness.replace('-', '_'), w_states))
+        # end of matrix
+        nexus.write(';\nEND;\n\n')
+
+        if tree_str:
+            nexus.write('\n\n')
+            nexus.write(tree_str)
+            nexus.write('\n\n')
+
+def read_collation(maxfiles, in_path, processes=None, cache_dir=None):
+    # read all the transcriptions in a single pass, including LEOnardi and
+    # all witnesses; the different outputs are views over this data
+    return read_data(maxfiles, in_path, True, [], processes, cache_dir)
+
+def collation_view(data, descripti=[], include_leo=True, prefixes=None,
+                   witnesses=None, drop_states=False, masks=None):
+    # build a view over `data`, without copying the states: only the set of
+    # witnesses (excluding `descripti` and, if requested, LEOnardi) and the
+    # dictionary of characters (for labels starting with any of `prefixes`,
+    # such as ('I',) for Inferno) are new objects; 'LEO' is still listed in
+    # the states when `include_leo` is False, but it is not output; if
+    # `witnesses` are given, only those are selected, and, with
+    # `drop_states`, the states without any selected witness are not
+    # output; the witness `masks` of the view (by default, those of `data`
+    # if it is a view, or new ones) can be shared by all the views of the
+    # same collation, as long as it does not change
+    instrument.count('views')
+    if witnesses is None:
+        witnesses = data['witnesses']
+    with instrument.stage('remove_descripti'):
+        witnesses = set(witnesses).intersection(data['witnesses'])
+        witnesses.difference_update(descripti)
+        if not include_leo:
+            witnesses.discard('LEO')
+
+    if prefixes:
+        chars = dict((k, v) for k, v in data['chars'].items()
+            if k.startswith(tuple(prefixes)))
+    else:
+        chars = data['chars']
+
+    return {
+        'chars' : chars,
+        'witnesses' : witnesses,
+        'manifest' : data.get('manifest'),
+        'masks' : masks or data.get('masks') or witness_masks(data),
+        'drop_states' : drop_states,
+    }
+
+def witness_subset(data, witnesses, masks=None):
+    # view of `data` with only the given `witnesses` and the states
+    # attested by them (or defaulted to), e.g., to test a hypothesis of
+    # eliminatio codicum descriptorum; all the subsets of a collation can
+    # share the same `masks`, so that the states of each character are
+    # turned into masks only once
+    return collation_view(data, witnesses=witnesses, drop_states=True,
+        masks=masks)
+
+# trees embedded in the reduced matrices
+TREES_STR = """
 BEGIN Trees;
 [TREES]
 [1] tree 'Tresoldi'=[&R] ((Rb, Urb),((Ash,Ham),((Triv,Mart,Mart_c2),LauSC)));
@@ -471,28 +934,114 @@ BEGIN Trees;
 END; [Trees]
 """
 
-    red_data = read_data(maxfiles, in_path, False, descripti)
-    output_data(red_data, '%s/tresoldi_red.nex' % out_path, [], trees_str)
-
-    # output inferno reduced
-    inferno = copy.deepcopy(red_data)
-    inferno['chars'] = \
-        dict((k,v) for k, v in inferno['chars'].items() if k[0] == 'I')
-    output_data(inferno, '%s/tresoldi_red.I.nex' % out_path, [], trees_str)
-
-    # output purgatorio reduced
-    purgatorio = copy.deepcopy(red_data)
-    purgatorio['chars'] = \
-        dict((k,v) for k, v in purgatorio['chars'].items() if k[0] == 'P')
-    output_data(purgatorio, '%s/tresoldi_red.P.nex' % out_path, [], trees_str)
+def export_job(out_file, descripti=[], include_leo=True, prefixes=None,
+               extra_data=None, trees=None, compress=False,
+               drop_invariant=False):
+    # declarative description of an output file: the view of the collation
+    # (witnesses without `descripti`, and characters starting with any of
+    # `prefixes`) and the arguments of `output_data()`; `trees` is a list
+    # of (name, function), with functions defined at module level (such as
+    # `treebuild.nj_tree`), so that jobs can be sent to other processes
+    return {
+        'out_file' : out_file,
+        'descripti' : list(descripti),
+        'include_leo' : include_leo,
+        'prefixes' : list(prefixes) if prefixes else None,
+        'extra_data' : extra_data,
+        'trees' : trees,
+        'compress' : compress,
+        'drop_invariant' : drop_invariant,
+    }
 
-    # output paradiso reduced
-    paradiso = copy.deepcopy(red_data)
-    paradiso['chars'] = \
-        dict((k,v) for k, v in paradiso['chars'].items() if k[0] == 'Z')
-    output_data(paradiso, '%s/tresoldi_red.Z.nex' % out_path, [], trees_str)
+def tonexus_jobs(out_path='data', native_trees=False):
+    # the files written by `tonexus()`: the full matrix, the reduced one
+    # (without the descripti), and the reduced matrix of each cantica
+    trees = None
+    if native_trees:
+        trees = [('NJ', treebuild.nj_tree), ('UPGMA', treebuild.upgma_tree)]
+
+    jobs = [export_job('%s/tresoldi.nex' % out_path)]
+    jobs.append(export_job('%s/tresoldi_red.nex' % out_path, DESCRIPTI,
+        False, None, TREES_STR, trees))
+    for cantica in ['I', 'P', 'Z']:
+        jobs.append(export_job('%s/tresoldi_red.%s.nex' % (out_path, cantica),
+            DESCRIPTI, False, [cantica], TREES_STR, trees))
+
+    return jobs
+
+def run_export(data, job, cache_dir=None, masks=None):
+    # write the output file of a job, returning the summary of
+    # `output_matrix()`; the witness `masks` can be shared by all jobs
+    view = collation_view(data, job['descripti'], job['include_leo'],
+        job['prefixes'], masks=masks)
+    return output_data(view, job['out_file'], [], job['extra_data'],
+        job['compress'], job['drop_invariant'], cache_dir, job['trees'])
+
+# collation and cache directory of the export workers, set by
+# `_init_export()`
+_export_data = {}
+
+def _init_export(data, cache_dir, instrumented):
+    _export_data['data'] = data
+    _export_data['cache_dir'] = cache_dir
+    _export_data['masks'] = witness_masks(data)
+    instrument.init_worker(instrumented)
+
+def _run_export(job):
+    # run a job in a worker, adding the stage timings, warnings and counters
+    # of the worker to the summary, to be merged by the parent
+    summary = run_export(_export_data['data'], job, _export_data['cache_dir'],
+        _export_data['masks'])
+    summary['instrument'] = instrument.totals()
+
+    return summary
+
+def run_exports(data, jobs, processes=None, cache_dir=None):
+    # write the output files of all `jobs` from the same (read-only)
+    # collation, with a pool of `processes` workers (all cpus by default,
+    # no pool if 1), each receiving the collation once; files are
+    # replaced only when complete, and their summaries are returned in the
+    # order in which they were written
+    if processes == 1 or len(jobs) < 2:
+        masks = witness_masks(data)
+        return [run_export(data, job, cache_dir, masks) for job in jobs]
+
+    with multiprocessing.Pool(min(processes or os.cpu_count(), len(jobs)),
+        _init_export, (data, cache_dir, instrument.enabled())) as pool:
+        summaries = list(pool.imap_unordered(_run_export, jobs))
+
+    for summary in summaries:
+        instrument.merge(summary.pop('instrument'))
+
+    return summaries
+
+def tonexus(maxfiles=None, in_path='data/transcription', out_path='data',
+            cache_dir=None, native_trees=False, report_file=None,
+            processes=None):
+    # read all data once and output; with a `cache_dir`, only the verses
+    # and matrix columns that changed since the last run are processed;
+    # with `native_trees`, NJ and UPGMA trees of each reduced matrix are
+    # added to its Trees blocks; with a `report_file`, the time spent in
+    # each stage (summed over all processes), counters and peak memory are
+    # written there as JSON; verses are read and files are written by a
+    # pool of `processes` workers
+    if report_file:
+        instrument.enable()
+
+    with instrument.stage('read_collation'):
+        data = read_collation(maxfiles, in_path, processes, cache_dir)
+
+    for summary in run_exports(data, tonexus_jobs(out_path, native_trees),
+        processes, cache_dir):
+        print('%(out_file)s: %(taxa)i taxa, %(chars)i characters' % summary)
+
+    if report_file:
+        instrument.write_report(report_file,
+            {'normalizer' : normalizer_stats()})
+        instrument.disable()
+    instrument.flush_warnings()
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.CRITICAL) # DEBUG
-    tonexus()
+    tonexus(cache_dir='data/cache')
 
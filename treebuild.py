@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Distance-based trees (neighbor-joining and UPGMA) built from the character
+# matrix, so that trees for any subset of the data (e.g., each cantica, or
+# windows of characters) can be generated in batch and embedded in the
+# Trees blocks of our NEXUS files, instead of coming from external programs.
+#
+# Both methods work on a square distance matrix (as returned by
+# `distances.distance_matrix()`) which is updated in place as clusters are
+# joined, so that memory is O(n^2) in the number of witnesses.
+
+import re
+
+import distances
+import newick
+import nexusio
+
+# contents of the first Trees block of a text, up to its END
+TREES_RE = re.compile(r'^BEGIN\s+Trees;[^\n]*\n(.*?)^END;',
+    re.IGNORECASE | re.MULTILINE | re.DOTALL)
+
+def _check_distances(taxa, dists):
+    # copy of the distance matrix, refusing pairs without distance
+    for i, row in enumerate(dists):
+        for j, dist in enumerate(row):
+            if dist is None:
+                raise ValueError('no distance between %s and %s' %
+                    (taxa[i], taxa[j]))
+
+    return [list(row) for row in dists]
+
+def nj(taxa, dists):
+    # neighbor-joining tree (unrooted, with a trifurcation at the root);
+    # negative branch lengths are set to zero
+    dists = _check_distances(taxa, dists)
+    nodes = [newick.new_node(taxon) for taxon in taxa]
+    active = list(range(len(taxa)))
+    if len(active) < 3:
+        return newick.new_node(children=nodes)
+
+    sums = [sum(row) for row in dists]
+    while len(active) > 3:
+        n = len(active)
+        best = None
+        for a_idx, i in enumerate(active):
+            for j in active[a_idx+1:]:
+                q = (n - 2) * dists[i][j] - sums[i] - sums[j]
+                if best is None or q < best[0]:
+                    best = (q, i, j)
+        _, i, j = best
+
+        # lengths of the new branches, and distances to the new node, which
+        # replaces `i` in the matrix
+        length_i = dists[i][j] / 2 + (sums[i] - sums[j]) / (2 * (n - 2))
+        length_j = dists[i][j] - length_i
+        nodes[i]['length'] = max(length_i, 0.0)
+        nodes[j]['length'] = max(length_j, 0.0)
+        nodes[i] = newick.new_node(children=[nodes[i], nodes[j]])
+
+        active.remove(j)
+        for k in active:
+            if k == i:
+                continue
+            dist = (dists[i][k] + dists[j][k] - dists[i][j]) / 2
+            sums[k] += dist - dists[i][k] - dists[j][k]
+            dists[i][k] = dists[k][i] = dist
+        sums[i] = sum([dists[i][k] for k in active if k != i])
+
+    # join the last three nodes at the root
+    i, j, k = active
+    for a, b, c in [(i, j, k), (j, i, k), (k, i, j)]:
+        nodes[a]['length'] = max((dists[a][b] + dists[a][c] -
+            dists[b][c]) / 2, 0.0)
+
+    return newick.new_node(children=[nodes[i], nodes[j], nodes[k]])
+
+def upgma(taxa, dists):
+    # UPGMA tree (rooted and ultrametric)
+    dists = _check_distances(taxa, dists)
+    nodes = [newick.new_node(taxon) for taxon in taxa]
+    sizes = [1] * len(taxa)
+    heights = [0.0] * len(taxa)
+    active = list(range(len(taxa)))
+
+    while len(active) > 1:
+        best = None
+        for a_idx, i in enumerate(active):
+            for j in active[a_idx+1:]:
+                if best is None or dists[i][j] < best[0]:
+                    best = (dists[i][j], i, j)
+        dist, i, j = best
+
+        height = dist / 2
+        nodes[i]['length'] = max(height - heights[i], 0.0)
+        nodes[j]['length'] = max(height - heights[j], 0.0)
+        nodes[i] = newick.new_node(children=[nodes[i], nodes[j]])
+        heights[i] = height
+
+        active.remove(j)
+        for k in active:
+            if k != i:
+                dists[i][k] = dists[k][i] = (dists[i][k] * sizes[i] +
+                    dists[j][k] * sizes[j]) / (sizes[i] + sizes[j])
+        sizes[i] += sizes[j]
+
+    return nodes[active[0]] if active else newick.new_node()
+
+def _build(method, matrix, options):
+    # tree with taxon labels as written in our NEXUS matrices
+    taxa = [taxon.replace('-', '_') for taxon in matrix['taxa']]
+    return method(taxa, distances.distance_matrix(matrix, **options))
+
+def nj_tree(matrix, **options):
+    # neighbor-joining tree of the p-distances of `matrix`; `options` are
+    # passed to `distances.distance_matrix()`
+    return _build(nj, matrix, options)
+
+def upgma_tree(matrix, **options):
+    return _build(upgma, matrix, options)
+
+def trees_block(trees):
+    # Trees block for a list of (name, root node), in the format of the
+    # blocks added to the NEXUS files by `tonexus()`; trees with a binary
+    # root (as those from `upgma()`) are marked as rooted
+    return '\nBEGIN Trees;\n[TREES]\n%sEND; [Trees]\n' % _tree_lines(trees)
+
+def _tree_lines(trees, start=0):
+    # tree commands for a list of (name, root node), numbered from start+1
+    buf = ''
+    for idx, (name, tree) in enumerate(trees):
+        buf += "[%i] tree '%s'=%s %s\n" % (start+idx+1,
+            name.replace("'", "''"),
+            '[&R]' if len(tree['children']) == 2 else '[&U]',
+            newick.to_newick(tree))
+
+    return buf
+
+def add_trees(text, trees):
+    # `text` (such as the extra data of a NEXUS file) with a list of (name,
+    # root node) added at the end of its Trees block, numbered after the
+    # trees already there, as some programs (e.g., PAUP and Mesquite) do
+    # not deal consistently with more than one block; a new block is
+    # appended if there is none
+    match = TREES_RE.search(text)
+    if match is None:
+        return text + trees_block(trees)
+
+    start = len([line for line in match.group(1).splitlines()
+        if nexusio.TREE_RE.match(line)])
+
+    return text[:match.end(1)] + _tree_lines(trees, start) + \
+        text[match.end(1):]
+
+def main():
+    # NJ and UPGMA trees for the reduced matrix and for each cantica
+    for suffix in ['', '.I', '.P', '.Z']:
+        matrix = nexusio.read_matrix('data/tresoldi_red%s.nex' % suffix)
+        print(trees_block([('NJ', nj_tree(matrix)),
+            ('UPGMA', upgma_tree(matrix))]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Batch comparison of many trees (e.g., bootstrap replicates, or all the
+# unrooted topologies for the reduced witnesses) against the same data: for
+# each tree, the parsimony length on the weighted site patterns, the
+# Robinson-Foulds distance to a reference tree, and, when the collation is
+# given, the ASR agreement score with PETrocchi computed by `test_asr`.
+#
+# Trees are passed to the workers of a process pool as Newick strings,
+# while the matrix, the reference splits and the score tables are sent
+# only once, to the initializer of each worker.
+
+import multiprocessing
+
+import charmatrix
+import newick
+import nexusio
+import parsimony
+import test_asr
+
+def splits(tree, taxa):
+    # set of the non-trivial bipartitions of an (unrooted) tree, each as the
+    # bit mask (over `taxa`) of the side not including the first taxon
+    bits = dict((taxon, 1 << idx) for idx, taxon in enumerate(taxa))
+    all_taxa = (1 << len(taxa)) - 1
+
+    ret = set()
+    below = {}
+    for node in newick.postorder(tree):
+        if not node['children']:
+            below[id(node)] = bits[node['name']]
+            continue
+
+        mask = 0
+        for child in node['children']:
+            mask |= below.pop(id(child))
+        below[id(node)] = mask
+
+        if mask & 1:
+            mask ^= all_taxa
+        if bin(mask).count('1') > 1 and bin(mask ^ all_taxa).count('1') > 1:
+            ret.add(mask)
+
+    return ret
+
+def rf_distance(tree_a, tree_b, taxa=None):
+    # Robinson-Foulds distance, the number of splits in only one of the
+    # trees
+    if taxa is None:
+        taxa = sorted(newick.leaf_names(tree_a))
+
+    return len(splits(tree_a, taxa) ^ splits(tree_b, taxa))
+
+def unrooted_topologies(taxa):
+    # yield all unrooted binary trees for `taxa` (as Newick root nodes, with
+    # a trifurcation at the root), by adding each taxon to every branch of
+    # the trees of the previous ones; there are (2n-5)!! of them, as
+    # parsimony lengths and RF distances do not depend on the root
+    if len(taxa) <= 3:
+        yield newick.new_node(children=[newick.new_node(taxon)
+            for taxon in taxa])
+        return
+
+    for tree in unrooted_topologies(taxa[:-1]):
+        for node in list(newick.preorder(tree))[1:]:
+            yield _insert(tree, node, taxa[-1])
+
+def _insert(tree, target, taxon):
+    # copy of `tree` with `taxon` as the sister of the `target` node
+    if tree is target:
+        return newick.new_node(children=[_copy(tree), newick.new_node(taxon)])
+    if not tree['children']:
+        return newick.new_node(tree['name'])
+
+    return newick.new_node(children=[_insert(child, target, taxon)
+        for child in tree['children']])
+
+def _copy(tree):
+    return newick.new_node(tree['name'], tree['length'],
+        [_copy(child) for child in tree['children']])
+
+# data shared by the workers, set by `_init_worker()`
+_worker_data = {}
+
+def _init_worker(matrix, reference, tables):
+    _worker_data['matrix'] = matrix
+    _worker_data['patterns'] = charmatrix.compress_patterns(matrix)
+    _worker_data['taxa'] = [taxon.replace('-', '_')
+        for taxon in matrix['taxa']]
+    _worker_data['reference'] = None
+    if reference is not None:
+        _worker_data['reference'] = splits(newick.parse_newick(reference),
+            _worker_data['taxa'])
+    _worker_data['tables'] = tables
+
+def _compare_tree(text):
+    # statistics of a single tree, in a worker
+    tree = newick.parse_newick(text)
+    ret = {
+        'tree' : text,
+        'length' : parsimony.fitch(tree, _worker_data['patterns'])[0],
+        'rf' : None,
+        'score' : None,
+    }
+
+    if _worker_data['reference'] is not None:
+        ret['rf'] = len(splits(tree, _worker_data['taxa']) ^
+            _worker_data['reference'])
+
+    if _worker_data['tables'] is not None:
+        asr, info_states = test_asr.tree_asr_data(tree,
+            _worker_data['matrix'])
+        scores = test_asr.score_batch(_worker_data['tables'], [asr])[0]
+        ret.update(scores)
+        ret['score'] = 1.0 - ((scores['wrong_single'] +
+            scores['wrong_multi']) / float(info_states))
+
+    return ret
+
+def compare_trees(trees, matrix, reference=None, nexus=None, processes=None,
+    chunksize=16):
+    # list of the statistics of each tree (Newick strings or root nodes),
+    # in order: `length` of the tree for the weighted site patterns of
+    # `matrix`, `rf` distance to the `reference` tree (if any), and the ASR
+    # `score` (with its right/wrong counts) against the `nexus` collation,
+    # as read by `transcription2nexus.read_data()` (if given); trees are
+    # compared by a pool of `processes` workers (all cpus by default, no
+    # pool if 1)
+    texts = [tree if isinstance(tree, str) else newick.to_newick(tree)
+        for tree in trees]
+    if reference is not None and not isinstance(reference, str):
+        reference = newick.to_newick(reference)
+    tables = test_asr.score_tables(nexus) if nexus is not None else None
+
+    if processes == 1 or len(texts) < 2:
+        _init_worker(matrix, reference, tables)
+        return list(map(_compare_tree, texts))
+
+    with multiprocessing.Pool(processes, _init_worker,
+        (matrix, reference, tables)) as pool:
+        return list(pool.imap(_compare_tree, texts, chunksize))
+
+def main():
+    # rank all the topologies of the reduced witnesses by length,
+    # reporting their distance to the 'Tresoldi' stemma
+    matrix = nexusio.read_matrix('data/tresoldi_red.nex')
+    reference = dict(nexusio.read_trees('data/tresoldi_red.nex'))['Tresoldi']
+    taxa = [taxon.replace('-', '_') for taxon in matrix['taxa']]
+
+    results = compare_trees(unrooted_topologies(taxa), matrix, reference)
+    results.sort(key=lambda result: (result['length'], result['rf']))
+    for result in results[:20]:
+        print(result['length'], result['rf'], result['tree'])
+
+if __name__ == '__main__':
+    main()